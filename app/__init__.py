@@ -1,14 +1,14 @@
 from flask.ext.login import LoginManager
 from flask.ext.bootstrap import Bootstrap
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.mail import Mail
 from flask.ext.moment import Moment
 from flask.ext.pagedown import PageDown
 from config import config
 from flask import Flask
+from .replicas import RoutingSQLAlchemy
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 mail = Mail()
 login_manager = LoginManager()
 moment = Moment()
@@ -31,6 +31,36 @@ def create_app(config_name):
     pagedown.init_app(app)
     db.init_app(app)
 
+    from . import replicas
+    replicas.init_app(app, db)
+
+    from . import query_budget
+    query_budget.init_app(app)
+
+    from . import slow_queries
+    slow_queries.init_app(app)
+
+    from . import rendering
+    rendering.init_app(app)
+
+    from . import last_seen
+    last_seen.init_app(app)
+
+    from . import follow_index
+    follow_index.init_app(app)
+
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import page_cache
+    page_cache.init_app(app)
+
+    from . import fragments
+    fragments.init_app(app)
+
+    from . import json_cache
+    json_cache.init_app(app)
+
     if not app.debug and not app.testing and not app.config['SSL_DISABLE']:
         from flask.ext.sslify import SSLify
         sslify = SSLify(app)
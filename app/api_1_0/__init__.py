@@ -1,5 +1,7 @@
 from flask import Blueprint
+from ..replicas import read_only
 
-api = Blueprint('api', __name__)
+# every GET of the API may be served from a read replica
+api = read_only(Blueprint('api', __name__))
 
 from . import authentication, posts, users, comments, errors
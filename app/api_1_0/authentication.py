@@ -1,14 +1,76 @@
+import hashlib
+import hmac
+import time
 from flask.ext.httpauth import HTTPBasicAuth
-from flask import g, jsonify
-from ..models import User, AnonymousUser, Permission
+from flask import g, jsonify, current_app
+from ..models import User, AnonymousUser, Permission, cached_user
+from ..cache import LRUCache
+from .. import db
 from . import api
 from .errors import unauthorized, forbidden
 
 auth = HTTPBasicAuth()
 
+# successful verifications, keyed by a keyed digest of the credentials so
+# that neither passwords nor tokens are kept in memory
+credential_cache = LRUCache(maxsize=10000)
+
+def _to_bytes(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+def credential_key(*credentials):
+    digest = hmac.new(_to_bytes(current_app.config['SECRET_KEY']),
+                      digestmod=hashlib.sha256)
+    for credential in credentials:
+        digest.update(_to_bytes(credential) + b'\0')
+    return digest.hexdigest()
+
+def verify_token(token):
+    """ the user a token was issued to, or None.  A cached verification
+        only holds while the user's token generation is unchanged, which
+        cached_user() reads from the database, so revoked tokens stop
+        working at once in every process.
+    """
+    key = credential_key('token', token)
+    entry = credential_cache.get(key)
+    if entry is None:
+        data = User.load_auth_token(token)
+        if data is None:
+            return None
+        id, generation, expires = data
+        ttl = min(current_app.config['FLASKY_CREDENTIAL_CACHE_TTL'],
+                  expires - time.time())
+        entry = (id, generation)
+        if ttl > 0:
+            credential_cache.set(key, entry, ttl=ttl)
+    user = cached_user(entry[0])
+    if user is None or (user.token_generation or 0) != entry[1]:
+        return None
+    return user
+
+def verify_credentials(email, password):
+    """ the user with email and password, or None.  A cached verification
+        only holds while the user's email and password hash are unchanged,
+        which cached_user() reads from the database with a primary key
+        lookup.
+    """
+    key = credential_key('password', email, password)
+    entry = credential_cache.get(key)
+    if entry is not None:
+        user = cached_user(entry[0])
+        if user is not None and user.email == email and \
+                user.password_hash == entry[1]:
+            return user
+    user = User.query.filter_by(email=email).first()
+    if user is None or not user.verify_password(password):
+        return None
+    credential_cache.set(key, (user.id, user.password_hash),
+                         ttl=current_app.config['FLASKY_CREDENTIAL_CACHE_TTL'])
+    return user
+
 """ The verification vallback returns True when the
 login is valid or False otherwise. Anonymous logins
-are supported, for which the client must send a 
+are supported, for which the client must send a
 blank email field. """
 @auth.verify_password
 def verify_password(email_or_token, password):
@@ -16,15 +78,15 @@ def verify_password(email_or_token, password):
         g.current_user = AnonymousUser()
         return True
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
+        g.current_user = verify_token(email_or_token)
         g.token_used = True
         return g.current_user is not None
-    user = User.query.filter_by(email=email_or_token).first()
+    user = verify_credentials(email_or_token, password)
     if not user:
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    return True
 
 @auth.error_handler
 def auth_error():
@@ -43,3 +105,11 @@ def get_token():
         return unauthorized('Invalid credentials')
     return jsonify({'token': g.current_user.generate_auth_token(
         expiration=3600), 'expiration': 3600})
+
+@api.route('/token', methods=['DELETE'])
+def revoke_tokens():
+    if g.current_user.is_anonymous():
+        return unauthorized('Invalid credentials')
+    g.current_user.revoke_auth_tokens()
+    db.session.commit()
+    return jsonify({'revoked': True})
@@ -1,7 +1,12 @@
 from .authentication import auth
 from . import api
 from ..models import Comment, Post
-from flask import current_app, request, jsonify, url_for
+from .pagination import paginate
+from ..json_cache import encoded, json_response
+from .etags import conditional, page_etag, last_modified
+from .fields import requested_fields, project
+from sqlalchemy.orm import load_only
+from flask import current_app
 
 @api.route('/comments/')
 @auth.login_required
@@ -10,27 +15,16 @@ def get_comments():
     comments = Comment.query.all()
     return jsonify({'comments': [comment.to_json() for comment in comments]})
     """
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.paginate(page,
-                                        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-                                        error_out=False)
-    comments = pagination.items
-    next = None
-    prev = None
-    if pagination.has_next:
-        next = url_for(
-            'api.get_comments', 
-            page=pagination.next_num, 
-            _external=True)
-    if pagination.has_prev:
-        prev = url_for(
-            'api.get_comments', 
-            page=pagination.prev_num, 
-            _external=True)
-    return jsonify({'comments': [comment.to_json() for comment in comments],
-                    'prev': prev,
-                    'next': next,
-                    'count': pagination.total})
+    fields = requested_fields(Comment)
+    page = paginate(project(Comment.query, Comment, fields),
+                    (Comment.timestamp, Comment.id), 'api.get_comments',
+                    per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
+    return conditional(page_etag(page, fields), last_modified(page.items),
+                       lambda: json_response({
+        'comments': [encoded(comment, fields) for comment in page.items],
+        'prev': page.prev,
+        'next': page.next,
+        'count': page.total}))
 
 @api.route('/comments/<int:id>')
 @auth.login_required
@@ -40,26 +34,18 @@ def get_post_comments(id):
     post_comments = post.comments
     return jsonify({'post_comments': [comment.to_json() for comment in post_comments]}})
     """
-    post = Post.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out=False)
-    post_comments = pagination.items
-    prev = None
-    next = None
-    if pagination.has_prev:
-        prev = url_for(
-            'api.get_post_comments', 
-            id=id, 
-            page=pagination.prev_num, 
-            _external=True)
-    if pagination.has_next:
-        next = url_for(
-            'api.get_post_comments', 
-            id=id, 
-            page=pagination.next_num, 
-            _external=True)
-    return jsonify({'post_comments': [comment.to_json() for comment in post_comments],
-                    'prev': prev,
-                    'next': next,
-                    'count': pagination.total})
+    fields = requested_fields(Comment)
+    # only the existence of the post matters here, not its body
+    post = Post.query.options(load_only('id')).get_or_404(id)
+    page = paginate(
+        project(post.comments, Comment, fields).order_by(
+            Comment.timestamp.desc()),
+        (Comment.timestamp, Comment.id), 'api.get_post_comments',
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'], id=id)
+    return conditional(page_etag(page, fields), last_modified(page.items),
+                       lambda: json_response({
+        'post_comments': [encoded(comment, fields)
+                          for comment in page.items],
+        'prev': page.prev,
+        'next': page.next,
+        'count': page.total}))
@@ -0,0 +1,48 @@
+import hashlib
+from flask import current_app, request
+
+def row_etag(row, fields=None):
+    """ a strong ETag for a versioned Post, Comment or User, or for the
+        given fields of it
+    """
+    etag = '%s-%d-%d' % (row.__tablename__, row.id, row.version)
+    if fields:
+        etag += '-' + '.'.join(fields)
+    return etag
+
+def page_etag(page, fields=None):
+    """ a strong ETag for a page of a listing, which changes with the
+        version of any row on it, with the rows on it and with the links
+        and the total of the page
+    """
+    digest = hashlib.sha1()
+    for row in page.items:
+        digest.update(row_etag(row, fields).encode('ascii'))
+    digest.update(repr((page.prev, page.next, page.total)).encode('utf-8'))
+    return digest.hexdigest()
+
+def last_modified(rows):
+    times = [row.updated_at for row in rows if row.updated_at is not None]
+    return max(times) if times else None
+
+def _not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    # HTTP dates have no fractions of a second
+    return since is not None and modified is not None and \
+        modified.replace(microsecond=0) <= since
+
+def conditional(etag, modified, build):
+    """ answer a conditional GET with 304 Not Modified when the client's
+        copy is current, otherwise call build for the full response.  Both
+        get the ETag and the Last-Modified headers.
+    """
+    if _not_modified(etag, modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+    return response
@@ -0,0 +1,28 @@
+from flask import request
+from sqlalchemy.orm import load_only
+from app.exceptions import ValidationError
+
+def requested_fields(model):
+    """ the fields of the model's representation asked for with
+        ?fields=a,b in canonical order, or None for the full representation
+    """
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = sorted(set(field.strip() for field in value.split(',')
+                        if field.strip()))
+    unknown = [field for field in fields if field not in model.JSON_FIELDS]
+    if unknown:
+        raise ValidationError('unknown fields: %s' % ', '.join(unknown))
+    return tuple(fields) or None
+
+def project(query, model, fields):
+    """ limit a query to the columns the requested fields need, the other
+        columns are deferred
+    """
+    if fields is None:
+        return query
+    columns = set(model.JSON_COLUMNS)
+    for field in fields:
+        columns.update(model.JSON_FIELDS[field][0])
+    return query.options(load_only(*sorted(columns)))
@@ -0,0 +1,103 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import request, url_for
+from app.exceptions import ValidationError
+from .. import db
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class Page(object):
+    def __init__(self, items, prev, next, total):
+        self.items = items
+        self.prev = prev
+        self.next = next
+        self.total = total
+
+def encode_cursor(direction, item):
+    """ an opaque cursor pointing just before or after the given row """
+    value = '%s|%s|%d' % (direction,
+                          item.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT),
+                          item.id)
+    return urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        value = urlsafe_b64decode(
+            (cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        direction, timestamp, id = value.decode('utf-8').split('|')
+        if direction not in ('prev', 'next'):
+            raise ValueError(direction)
+        return direction, \
+            datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (TypeError, ValueError):
+        raise ValidationError('invalid cursor')
+
+def paginate(query, keys, endpoint, per_page, **kwargs):
+    """ paginate an API listing.
+
+        Without a cursor argument the classic ?page=N mode is used, which
+        runs an OFFSET scan plus a COUNT(*) and is kept for existing clients.
+        Passing ?cursor= (empty for the first page) switches to keyset
+        pagination on the (timestamp, id) columns given in keys, newest
+        first, which costs the same at any depth; the total is then only
+        computed when ?count=1 is given.
+    """
+    if request.args.get('fields'):
+        # the links to the other pages keep the sparse fieldset
+        kwargs['fields'] = request.args['fields']
+    if 'cursor' not in request.args:
+        page = request.args.get('page', 1, type=int)
+        pagination = query.paginate(page, per_page=per_page, error_out=False)
+        prev = None
+        next = None
+        if pagination.has_prev:
+            prev = url_for(endpoint, page=pagination.prev_num,
+                           _external=True, **kwargs)
+        if pagination.has_next:
+            next = url_for(endpoint, page=pagination.next_num,
+                           _external=True, **kwargs)
+        return Page(pagination.items, prev, next, pagination.total)
+
+    cursor = request.args.get('cursor', '')
+    timestamp_key, id_key = keys
+    query = query.order_by(None)
+    backwards = False
+    keyset = query
+    if cursor:
+        direction, timestamp, id = decode_cursor(cursor)
+        backwards = direction == 'prev'
+        if backwards:
+            keyset = keyset.filter(db.or_(
+                timestamp_key > timestamp,
+                db.and_(timestamp_key == timestamp, id_key > id)))
+        else:
+            keyset = keyset.filter(db.or_(
+                timestamp_key < timestamp,
+                db.and_(timestamp_key == timestamp, id_key < id)))
+    if backwards:
+        keyset = keyset.order_by(timestamp_key.asc(), id_key.asc())
+    else:
+        keyset = keyset.order_by(timestamp_key.desc(), id_key.desc())
+    # one extra row tells whether there is anything beyond this page
+    items = keyset.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    total = None
+    if request.args.get('count', 0, type=int):
+        total = query.count()
+        kwargs['count'] = 1
+    has_prev = more if backwards else bool(cursor)
+    has_next = bool(cursor) if backwards else more
+    prev = None
+    next = None
+    if items:
+        if has_prev:
+            prev = url_for(endpoint, cursor=encode_cursor('prev', items[0]),
+                           _external=True, **kwargs)
+        if has_next:
+            next = url_for(endpoint, cursor=encode_cursor('next', items[-1]),
+                           _external=True, **kwargs)
+    return Page(items, prev, next, total)
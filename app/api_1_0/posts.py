@@ -3,6 +3,10 @@ from .decorators import permission_required
 from ..models import Permission, Post
 from . import api
 from .errors import forbidden
+from .pagination import paginate
+from ..json_cache import encoded, json_response
+from .etags import conditional, row_etag, page_etag, last_modified
+from .fields import requested_fields, project
 from app import db
 
 
@@ -12,29 +16,24 @@ def get_posts():
     posts = Post.query.all()
     return jsonify({ 'posts': [post.to_json() for post in posts]})
     """
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.paginate(
-        page,
-        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    prev = None
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_posts', page=pagination.next_num, _external=True)
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=pagination.prev_num, _external=True)
-    return jsonify({
-        "posts": [post.to_json() for post in posts],
-        "prev": prev,
-        "next": next,
-        "count": pagination.total
-    })
+    fields = requested_fields(Post)
+    page = paginate(project(Post.query, Post, fields),
+                    (Post.timestamp, Post.id), 'api.get_posts',
+                    per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
+    return conditional(page_etag(page, fields), last_modified(page.items),
+                       lambda: json_response({
+        "posts": [encoded(post, fields) for post in page.items],
+        "prev": page.prev,
+        "next": page.next,
+        "count": page.total
+    }))
 
 @api.route('/posts/<int:id>')
 def get_post(id):
-    post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    fields = requested_fields(Post)
+    post = project(Post.query, Post, fields).get_or_404(id)
+    return conditional(row_etag(post, fields), post.updated_at,
+                       lambda: json_response(encoded(post, fields)))
 
 @api.route('/posts/', methods=['POST'])
 @permission_required(Permission.WRITE_ARTICLES)
@@ -43,9 +42,23 @@ def new_post():
     post.author = g.current_user
     db.session.add(post)
     db.session.commit()
+    if current_app.config['FLASKY_ASYNC_RENDERING']:
+        # the body is still being rendered, point the client at its status
+        status_url = url_for('api.get_post_status', id=post.id, _external=True)
+        return jsonify({'url': url_for('api.get_post', id=post.id,
+                                       _external=True),
+                        'status': 'pending',
+                        'status_url': status_url}), 202, \
+            {'Location': status_url}
     return jsonify(post.to_json()), 201, \
             {'Location': url_for('api.get_post', id=post.id, _external=True)}
 
+@api.route('/posts/<int:id>/status')
+def get_post_status(id):
+    post = Post.query.get_or_404(id)
+    return jsonify({'url': url_for('api.get_post', id=post.id, _external=True),
+                    'status': 'pending' if post.body_html is None else 'ready'})
+
 @api.route('/posts/<int:id>', methods=['PUT'])
 @permission_required(Permission.WRITE_ARTICLES)
 def edit_post(id):
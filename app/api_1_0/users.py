@@ -1,15 +1,21 @@
 from . import api
 from .authentication import auth
 from ..models import User, Post
-from flask import current_app, request, jsonify, url_for
+from .pagination import paginate
+from ..json_cache import encoded, json_response
+from .etags import conditional, row_etag, page_etag, last_modified
+from .fields import requested_fields, project
+from flask import current_app
 
 @api.route('/users/<int:id>')
 @auth.login_required
 def get_user(id):
-    user = User.query.get_or_404(id)
-    return jsonify({
-        'user': user.to_json()
-    })
+    fields = requested_fields(User)
+    user = project(User.query, User, fields).get_or_404(id)
+    return conditional(row_etag(user, fields), user.updated_at,
+                       lambda: json_response({
+        'user': encoded(user, fields)
+    }))
 
 @api.route('/users/<int:id>/posts/')
 @auth.login_required
@@ -19,25 +25,19 @@ def get_user_posts(id):
     posts = Posts.query.filter_by(author=user).all()
     return jsonify({'user_posts': [post.to_json() for post in posts]})
     """
+    fields = requested_fields(Post)
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter_by(author=user).paginate(
-                    page,
+    page = paginate(project(Post.query.filter_by(author=user), Post, fields),
+                    (Post.timestamp, Post.id), 'api.get_user_posts',
                     per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                    error_out=False)
-    user_posts = pagination.items
-    next = None
-    prev = None
-    if pagination.has_next:
-        next = url_for('api.get_user_posts', id=id, page=pagination.next_num, _external=True)
-    if pagination.has_prev:
-        prev = url_for('api.get_user_posts', id=id, page=pagination.prev_num, _external=True)
-    return jsonify({
-        'user_posts': [post.to_json() for post in user_posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+                    id=id)
+    return conditional(page_etag(page, fields), last_modified(page.items),
+                       lambda: json_response({
+        'user_posts': [encoded(post, fields) for post in page.items],
+        'prev': page.prev,
+        'next': page.next,
+        'count': page.total
+    }))
 
 
 @api.route('/users/<int:id>/timeline/')
@@ -48,23 +48,17 @@ def get_user_followed_posts(id):
     posts = user.followed_posts.order_by(Post.timestamp.desc())
     return jsonify({'followed_posts': [post.jsonify() for post in posts]})
     """
+    fields = requested_fields(Post)
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-            page=page, 
-            per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-            error_out=False)
-    followed_posts = pagination.items
-    next = None
-    prev = None
-    if pagination.has_next:
-        next = url_for('api.get_user_followed_posts', id=id, page=pagination.next_num, _external=True)
-    if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', id=id, page=pagination.prev_num, _external=True)
-    return jsonify({
-        'followed_posts': [post.to_json() for post in followed_posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
-
+    query, keys = user.timeline()
+    page = paginate(project(query, Post, fields), keys,
+                    'api.get_user_followed_posts',
+                    per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+                    id=id)
+    return conditional(page_etag(page, fields), last_modified(page.items),
+                       lambda: json_response({
+        'followed_posts': [encoded(post, fields) for post in page.items],
+        'prev': page.prev,
+        'next': page.next,
+        'count': page.total
+    }))
@@ -0,0 +1,351 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from random import Random
+from sqlalchemy import create_engine, text
+from . import db
+
+# the composite indexes matching the hot query shapes, as declared on the
+# models; the benchmark runs every query without and then with them
+COMPOSITE_INDEXES = [
+    ('posts', 'ix_posts_author_id_timestamp'),
+    ('comments', 'ix_comments_post_id_timestamp'),
+    ('follows', 'ix_follows_followed_id_timestamp'),
+    ('follows', 'ix_follows_follower_id_timestamp'),
+]
+
+HOT_QUERIES = [
+    ('posts of a user', 'users',
+     'SELECT id FROM posts WHERE author_id = :id '
+     'ORDER BY timestamp DESC LIMIT 15'),
+    ('comments of a post', 'posts',
+     'SELECT id FROM comments WHERE post_id = :id '
+     'ORDER BY timestamp DESC LIMIT 15'),
+    ('followers of a user', 'users',
+     'SELECT follower_id FROM follows WHERE followed_id = :id '
+     'ORDER BY timestamp DESC LIMIT 25'),
+    ('users followed by a user', 'users',
+     'SELECT followed_id FROM follows WHERE follower_id = :id '
+     'ORDER BY timestamp DESC LIMIT 25'),
+]
+
+def _echo(message):
+    print(message)
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def _seed_index_dataset(engine, users, posts, comments, follows, seed):
+    """ a small dataset with the real schema, inserted with executemany """
+    rnd = Random(seed)
+    start = datetime(2015, 1, 1)
+    tables = db.metadata.tables
+
+    def when():
+        return start + timedelta(seconds=rnd.randint(0, 365 * 24 * 3600))
+
+    def batches(rows, size=10000):
+        for i in range(0, len(rows), size):
+            yield rows[i:i + size]
+
+    with engine.begin() as connection:
+        rows = [{'id': i, 'email': 'user%d@example.com' % i,
+                 'username': 'user%d' % i, 'confirmed': True}
+                for i in range(1, users + 1)]
+        for batch in batches(rows):
+            connection.execute(tables['users'].insert(), batch)
+        rows = [{'id': i, 'author_id': rnd.randint(1, users),
+                 'body': 'post', 'timestamp': when()}
+                for i in range(1, posts + 1)]
+        for batch in batches(rows):
+            connection.execute(tables['posts'].insert(), batch)
+        rows = [{'id': i, 'post_id': rnd.randint(1, posts),
+                 'author_id': rnd.randint(1, users),
+                 'body': 'comment', 'timestamp': when()}
+                for i in range(1, comments + 1)]
+        for batch in batches(rows):
+            connection.execute(tables['comments'].insert(), batch)
+        pairs = set()
+        while len(pairs) < follows:
+            pairs.add((rnd.randint(1, users), rnd.randint(1, users)))
+        rows = [{'follower_id': follower, 'followed_id': followed,
+                 'timestamp': when()} for follower, followed in pairs]
+        for batch in batches(rows):
+            connection.execute(tables['follows'].insert(), batch)
+
+def query_plan(connection, statement, params):
+    if connection.dialect.name == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    else:
+        explain = 'EXPLAIN '
+    rows = connection.execute(text(explain + statement), params).fetchall()
+    return [' '.join(str(column) for column in row) for row in rows]
+
+def benchmark_indexes(users=10000, posts=200000, comments=400000,
+                      follows=200000, repeat=200, seed=0, output=_echo):
+    """ seed a scratch SQLite database and compare the plan and latency of
+        the hot queries without and with the composite indexes
+    """
+    tmpdir = tempfile.mkdtemp()
+    engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'bench.sqlite'))
+    try:
+        db.metadata.create_all(engine)
+        indexes = []
+        for table, name in COMPOSITE_INDEXES:
+            index = [i for i in db.metadata.tables[table].indexes
+                     if i.name == name][0]
+            index.drop(engine)
+            indexes.append(index)
+        output('Seeding %d users, %d posts, %d comments, %d follows...' %
+               (users, posts, comments, follows))
+        _seed_index_dataset(engine, users, posts, comments, follows, seed)
+        limits = {'users': users, 'posts': posts}
+
+        results = {}
+        for phase in ('without indexes', 'with indexes'):
+            if phase == 'with indexes':
+                for index in indexes:
+                    index.create(engine)
+            engine.execute('ANALYZE')
+            output('\n== %s ==' % phase)
+            rnd = Random(seed)
+            with engine.connect() as connection:
+                for name, table, statement in HOT_QUERIES:
+                    plan = query_plan(connection, statement, {'id': 1})
+                    timings = []
+                    for i in range(repeat):
+                        params = {'id': rnd.randint(1, limits[table])}
+                        start = time.time()
+                        connection.execute(text(statement), params).fetchall()
+                        timings.append((time.time() - start) * 1000)
+                    result = {'plan': plan,
+                              'p50_ms': percentile(timings, 50),
+                              'p99_ms': percentile(timings, 99)}
+                    results.setdefault(name, {})[phase] = result
+                    output('%s\n    plan: %s\n    p50 %.3fms  p99 %.3fms' %
+                           (name, ' / '.join(plan),
+                            result['p50_ms'], result['p99_ms']))
+        return results
+    finally:
+        engine.dispose()
+        shutil.rmtree(tmpdir)
+
+# (name, method, url template, needs a logged in web client); the API
+# scenarios authenticate with the seeded user's email and password
+SCENARIOS = [
+    ('index (anonymous)', 'GET', '/?page={page}', False),
+    ('index (followed)', 'GET', '/?page={page}', True),
+    ('post page', 'GET', '/post/{post}', False),
+    ('profile page', 'GET', '/user/user{user}', False),
+    ('write post', 'POST', '/', True),
+    ('write comment', 'POST', '/post/{post}', True),
+    ('api posts', 'GET', '/api/v1.0/posts/', False),
+    ('api post', 'GET', '/api/v1.0/posts/{post}', False),
+    ('api post status', 'GET', '/api/v1.0/posts/{post}/status', False),
+    ('api new post', 'POST', '/api/v1.0/posts/', False),
+    ('api edit post', 'PUT', '/api/v1.0/posts/{own_post}', False),
+    ('api comments', 'GET', '/api/v1.0/comments/', False),
+    ('api post comments', 'GET', '/api/v1.0/comments/{post}', False),
+    ('api user', 'GET', '/api/v1.0/users/{user}', False),
+    ('api user posts', 'GET', '/api/v1.0/users/{user}/posts/', False),
+    ('api user timeline', 'GET', '/api/v1.0/users/{user}/timeline/', False),
+    ('api token', 'GET', '/api/v1.0/token', False),
+    ('api revoke tokens', 'DELETE', '/api/v1.0/token', False),
+]
+
+def _run_scenario(app, scenario, requests, warmup, rnd, dataset):
+    from base64 import b64encode
+    from .seed import SEED_PASSWORD
+    name, method, url, logged_in = scenario
+    user = dataset['bench_user']
+    client = app.test_client(use_cookies=True)
+    if logged_in:
+        client.post('/auth/login', base_url=dataset['base_url'],
+                    data={'email': 'user%d@example.com' % user,
+                          'password': SEED_PASSWORD})
+        client.get('/followed', base_url=dataset['base_url'])
+    credentials = ('user%d@example.com:%s' % (user, SEED_PASSWORD)).encode()
+    headers = {'Authorization': 'Basic ' + b64encode(credentials).decode(),
+               'Accept': 'application/json'}
+    timings = []
+    errors = 0
+    elapsed = 0.0
+    for i in range(warmup + requests):
+        path = url.format(page=rnd.randint(1, dataset['pages']),
+                          post=rnd.randint(*dataset['posts']),
+                          user=rnd.randint(*dataset['users']),
+                          own_post=dataset['own_post'])
+        kwargs = {'method': method, 'base_url': dataset['base_url']}
+        if path.startswith('/api/'):
+            kwargs['headers'] = headers
+            if method in ('POST', 'PUT'):
+                kwargs['data'] = json.dumps({'body': 'benchmark %d' % i})
+                kwargs['content_type'] = 'application/json'
+        elif method == 'POST':
+            kwargs['data'] = {'body': 'benchmark %d' % i}
+        start = time.time()
+        response = client.open(path, **kwargs)
+        duration = time.time() - start
+        if i < warmup:
+            continue
+        elapsed += duration
+        timings.append(duration * 1000)
+        if response.status_code >= 400:
+            errors += 1
+    return {'requests': requests,
+            'errors': errors,
+            'seconds': elapsed,
+            'rps': requests / elapsed if elapsed else 0.0,
+            'mean_ms': sum(timings) / len(timings) if timings else 0.0,
+            'p50_ms': percentile(timings, 50),
+            'p95_ms': percentile(timings, 95),
+            'p99_ms': percentile(timings, 99)}
+
+def run_benchmark(app, users=200, posts=2000, comments=4000, follows=20,
+                  requests=200, warmup=10, seed=0, scenarios=None,
+                  database=None, output=_echo):
+    """ seed a dataset and drive the main scenarios through the test client,
+        returns the throughput and latency percentiles of every scenario.
+
+        Unless a database URL is given the dataset goes to a scratch SQLite
+        database, deleted afterwards.  The requests run on a thread of
+        their own, so every request gets its own application context as
+        it would under a real server.
+    """
+    from .seed import seed as seed_database
+    from .models import Post, User
+    selected = [s for s in SCENARIOS if not scenarios or s[0] in scenarios]
+    overrides = {'WTF_CSRF_ENABLED': False, 'FLASKY_REPLICA_BINDS': [],
+                 'FLASKY_SLOW_QUERY_LOG': None}
+    tmpdir = None
+    if database is None:
+        tmpdir = tempfile.mkdtemp()
+        database = 'sqlite:///' + os.path.join(tmpdir, 'bench.sqlite')
+    overrides['SQLALCHEMY_DATABASE_URI'] = database
+    saved = dict((key, app.config.get(key)) for key in overrides)
+    app.config.update(overrides)
+    results = {'dataset': {'users': users, 'posts': posts,
+                           'comments': comments, 'follows': follows,
+                           'seed': seed},
+               'requests': requests,
+               'time': datetime.utcnow().isoformat(),
+               'scenarios': {}}
+    failure = []
+
+    def work():
+        try:
+            with app.app_context():
+                db.create_all()
+                seed_database(users=users, posts=posts, comments=comments,
+                              follows=follows, seed=seed, output=output)
+                # the most followed author, with one of the heaviest pages
+                bench_user = db.session.query(User.id).filter(
+                    User.post_count > 0).order_by(
+                    User.followers_count.desc()).first()[0]
+                own_post = db.session.query(db.func.max(Post.id)).filter(
+                    Post.author_id == bench_user).scalar()
+                dataset = {
+                    'users': db.session.query(db.func.min(User.id),
+                                              db.func.max(User.id)).one(),
+                    'posts': db.session.query(db.func.min(Post.id),
+                                              db.func.max(Post.id)).one(),
+                    'pages': max(1, posts // app.config[
+                        'FLASKY_POSTS_PER_PAGE']),
+                    'bench_user': bench_user,
+                    'own_post': own_post,
+                    # SSLify redirects plain HTTP outside of debug mode
+                    'base_url': 'https://localhost/'}
+                db.session.remove()
+            rnd = Random(seed)
+            for scenario in selected:
+                result = _run_scenario(app, scenario, requests, warmup, rnd,
+                                       dataset)
+                results['scenarios'][scenario[0]] = result
+                output('%-22s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  '
+                       'p99 %7.2fms%s' % (
+                           scenario[0], result['rps'], result['p50_ms'],
+                           result['p95_ms'], result['p99_ms'],
+                           '  (%d errors)' % result['errors']
+                           if result['errors'] else ''))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            if tmpdir is not None:
+                with app.app_context():
+                    db.session.remove()
+                    db.drop_all()
+                    db.get_engine(app).dispose()
+
+    try:
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    finally:
+        app.config.update(saved)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    if failure:
+        raise failure[0]
+    return results
+
+# compared between runs; the throughput is better higher, the latencies lower
+METRICS = ('rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def regressions(changes, threshold):
+    """ the (scenario, metric, relative change) of every metric of changes
+        that got worse by more than threshold, a fraction
+    """
+    found = []
+    for name in sorted(changes):
+        for metric in METRICS:
+            change = changes[name][metric]
+            worse = -change if metric == 'rps' else change
+            if worse > threshold:
+                found.append((name, metric, change))
+    return found
+
+def diff_results(old, new, threshold=0.1, output=_echo):
+    """ print the change in throughput and latency of every scenario of two
+        benchmark runs and the regressions beyond threshold, a fraction,
+        returns {scenario: {metric: relative change}}
+    """
+    changes = {}
+    output('%-22s %10s %10s %10s %10s' % ('', 'req/s', 'p50', 'p95', 'p99'))
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        before = old['scenarios'][name]
+        after = new['scenarios'][name]
+        change = {}
+        for metric in METRICS:
+            if before[metric]:
+                change[metric] = (after[metric] - before[metric]) / \
+                    before[metric]
+            else:
+                change[metric] = 0.0
+        changes[name] = change
+        output('%-22s %+9.1f%% %+9.1f%% %+9.1f%% %+9.1f%%' % (
+            name, change['rps'] * 100, change['p50_ms'] * 100,
+            change['p95_ms'] * 100, change['p99_ms'] * 100))
+    for name in sorted(set(old['scenarios']) ^ set(new['scenarios'])):
+        output('%-22s only in %s run' % (
+            name, 'the old' if name in old['scenarios'] else 'the new'))
+    found = regressions(changes, threshold)
+    for name, metric, change in found:
+        output('Regression: %s %s %+.1f%%' % (name, metric, change * 100))
+    if not found:
+        output('No regression over %.0f%%' % (threshold * 100))
+    return changes
@@ -0,0 +1,27 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+def after_commit(session, callback):
+    """ call callback once the session's current transaction is committed,
+        it is discarded if the transaction is rolled back instead
+    """
+    session.info.setdefault('after_commit', []).append(callback)
+
+def after_rollback(session, callback):
+    """ call callback if the session's current transaction is rolled back,
+        it is discarded once the transaction is committed instead
+    """
+    session.info.setdefault('after_rollback', []).append(callback)
+
+def _on_commit(session):
+    session.info.pop('after_rollback', None)
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+def _on_rollback(session):
+    session.info.pop('after_commit', None)
+    for callback in session.info.pop('after_rollback', []):
+        callback()
+
+event.listen(Session, 'after_commit', _on_commit)
+event.listen(Session, 'after_rollback', _on_rollback)
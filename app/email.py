@@ -1,11 +1,25 @@
 from flask.ext.mail import Mail, Message
 from flask import render_template, current_app
-from threading import Thread
+from threading import Thread, Lock
 from . import mail
 
+# messages handed to a sending thread and not sent yet
+_pending = [0]
+_pending_lock = Lock()
+
+def mail_queue_depth():
+    return _pending[0]
+
+def _add_pending(n):
+    with _pending_lock:
+        _pending[0] += n
+
 def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    try:
+        with app.app_context():
+            mail.send(msg)
+    finally:
+        _add_pending(-1)
 
 def send_mail(to, subject, template, **kwargs):
     app = current_app._get_current_object()
@@ -14,6 +28,7 @@ def send_mail(to, subject, template, **kwargs):
                   recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
+    _add_pending(1)
     thr = Thread(target=send_async_email, args=[app, msg])
     thr.start()
     return thr
\ No newline at end of file
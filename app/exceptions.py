@@ -1,2 +1,5 @@
 class ValidationError(ValueError):
     pass
+
+class QueryBudgetExceeded(Exception):
+    pass
@@ -0,0 +1,146 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from . import db
+
+def _contains(ids, id):
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+def _with(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        return ids
+    return ids[:i] + array('l', [id]) + ids[i:]
+
+def _without(ids, id):
+    i = bisect_left(ids, id)
+    if i == len(ids) or ids[i] != id:
+        return ids
+    return ids[:i] + ids[i + 1:]
+
+class FollowIndex(object):
+    """ per process adjacency index of the follows table.
+
+        Every user maps to a sorted array of the ids they follow and another
+        of the ids following them, so membership is a binary search and
+        counts are array lengths.  Arrays are replaced, never changed in
+        place, so readers need no lock.  The index is built from the follows
+        table on first use, kept current by the follows this process
+        commits and rebuilt by a background thread every
+        FLASKY_FOLLOW_INDEX_TTL seconds to pick up the writes of other
+        processes.  It can be that far behind them, so it only serves what
+        pages show; the follow and unfollow paths ask the database.
+    """
+    EMPTY = array('l')
+
+    def __init__(self):
+        self.app = None
+        self.ttl = None
+        # (built at, followed arrays, follower arrays), replaced as a whole
+        self.state = None
+        self.refresher = None
+        # changes made while a rebuild reads the table, replayed on its result
+        self._changes = None
+        # bumped by invalidate(), so a rebuild under way is not installed
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config['FLASKY_FOLLOW_INDEX_TTL']
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._generation += 1
+            self.state = None
+
+    def rebuild(self):
+        follows = db.metadata.tables['follows']
+        built = time.time()
+        followed = {}
+        followers = {}
+        with self._lock:
+            self._changes = []
+            generation = self._generation
+        # from the primary, never from a replica that may lag behind
+        rows = db.get_engine(self.app).execute(
+            db.select([follows.c.follower_id, follows.c.followed_id]).
+            order_by(follows.c.follower_id, follows.c.followed_id))
+        for follower_id, followed_id in rows:
+            ids = followed.get(follower_id)
+            if ids is None:
+                ids = followed[follower_id] = array('l')
+            ids.append(followed_id)
+            ids = followers.get(followed_id)
+            if ids is None:
+                ids = followers[followed_id] = array('l')
+            # rows come in follower order, so these stay sorted as well
+            ids.append(follower_id)
+        state = (built, followed, followers)
+        with self._lock:
+            for follower_id, followed_id, change in self._changes or ():
+                self._apply(state, follower_id, followed_id, change)
+            self._changes = None
+            if generation == self._generation:
+                self.state = state
+        return state
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.rebuild()
+            except Exception:
+                self.app.logger.exception('Rebuilding the follow index failed')
+
+    def _state(self):
+        state = self.state
+        if state is None:
+            state = self.rebuild()
+        if self.refresher is None and self.ttl:
+            with self._lock:
+                if self.refresher is None:
+                    self.refresher = threading.Thread(target=self._refresh)
+                    self.refresher.daemon = True
+                    self.refresher.start()
+        return state
+
+    def _apply(self, state, follower_id, followed_id, change):
+        built, followed, followers = state
+        followed[follower_id] = change(
+            followed.get(follower_id, self.EMPTY), followed_id)
+        followers[followed_id] = change(
+            followers.get(followed_id, self.EMPTY), follower_id)
+
+    def _update(self, follower_id, followed_id, change):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((follower_id, followed_id, change))
+            if self.state is not None:
+                self._apply(self.state, follower_id, followed_id, change)
+
+    def add(self, follower_id, followed_id):
+        self._update(follower_id, followed_id, _with)
+
+    def remove(self, follower_id, followed_id):
+        self._update(follower_id, followed_id, _without)
+
+    def is_following(self, follower_id, followed_id):
+        return _contains(self._state()[1].get(follower_id, self.EMPTY),
+                         followed_id)
+
+    def is_mutual(self, id1, id2):
+        return self.is_following(id1, id2) and self.is_following(id2, id1)
+
+    def followed_count(self, id):
+        return len(self._state()[1].get(id, self.EMPTY))
+
+    def followers_count(self, id):
+        return len(self._state()[2].get(id, self.EMPTY))
+
+follow_index = FollowIndex()
+
+def init_app(app):
+    follow_index.init_app(app)
@@ -0,0 +1,58 @@
+from flask import render_template, request
+from flask.ext.login import current_user
+from jinja2 import Markup
+from .cache import LRUCache
+
+# where the markup that depends on the viewer goes in a cached fragment
+SLOT = Markup('<!-- viewer controls -->')
+
+# rendered posts and comments, keyed by row version, so they never need
+# to be invalidated
+fragment_cache = LRUCache(maxsize=10000)
+
+def _fragment(key, template, **context):
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template(template, viewer_controls=SLOT, **context)
+        fragment_cache.set(key, html)
+    return html
+
+def _author_key(row):
+    # what a fragment shows of the author, the author's version also moves
+    # with every last_seen update
+    author = row.author
+    return author.username, author.avatar_hash or author.email
+
+def post_fragment(post):
+    """ the markup of a post in a listing.  The fragment is the same for
+        every viewer and cached by version; the edit button of authors and
+        administrators is rendered on top of it.
+    """
+    key = ('posts', post.id, post.version, _author_key(post),
+           request.is_secure)
+    html = _fragment(key, '_post.html', post=post)
+    controls = ''
+    if current_user == post.author or current_user.is_administrator():
+        controls = render_template('_post_controls.html', post=post)
+    return Markup(html.replace(SLOT, controls, 1))
+
+def comment_fragment(comment, moderate=False, page=None):
+    """ the markup of a comment in a listing, cached by version and by the
+        viewer's role class: moderators see the body of disabled comments.
+        Their enable and disable buttons are rendered on top of it.
+    """
+    role = 'moderator' if moderate else 'reader'
+    key = ('comments', comment.id, comment.version, _author_key(comment),
+           request.is_secure, role)
+    html = _fragment(key, '_comment.html', comment=comment,
+                     moderate=bool(moderate))
+    controls = ''
+    if moderate:
+        controls = render_template('_comment_controls.html',
+                                   comment=comment, page=page)
+    return Markup(html.replace(SLOT, controls, 1))
+
+def init_app(app):
+    fragment_cache.maxsize = app.config['FLASKY_FRAGMENT_CACHE_SIZE']
+    app.add_template_global(post_fragment)
+    app.add_template_global(comment_fragment)
@@ -0,0 +1,91 @@
+import threading
+from functools import partial
+from flask import current_app, json, request
+from sqlalchemy import inspect
+from .cache import LRUCache
+from .commit_hooks import after_commit
+from .metrics import timed
+
+class Encoded(object):
+    """ a value already encoded as JSON, spliced into responses as is """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+class JSONCache(object):
+    """ per process cache of the encoded JSON representation of Posts,
+        Comments and Users.
+
+        Entries are keyed by table, id and URL root, since representations
+        hold external URLs, and carry the version of the row they were
+        encoded from, so a row changed by any process is encoded again.
+        The model events also drop the entries of the rows they update or
+        delete once the transaction commits.
+    """
+    def __init__(self, maxsize=10000):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.roots = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.cache.maxsize = app.config['FLASKY_JSON_CACHE_SIZE']
+
+    def encoded(self, row, fields=None):
+        state = inspect(row)
+        if state.modified or not state.has_identity:
+            # changes not flushed yet have no version of their own
+            return Encoded(json.dumps(row.to_json(fields)))
+        root = request.url_root
+        key = (row.__tablename__, row.id, root, fields)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == row.version:
+            return entry[1]
+        if root not in self.roots:
+            with self._lock:
+                self.roots = self.roots | set([root])
+        encoded = Encoded(json.dumps(row.to_json(fields)))
+        self.cache.set(key, (row.version, encoded))
+        return encoded
+
+    def forget(self, table, id):
+        # sparse fieldsets expire with the version instead
+        for root in self.roots:
+            self.cache.pop((table, id, root, None))
+
+    def forget_on_commit(self, session, row):
+        after_commit(session, partial(self.forget, row.__tablename__, row.id))
+
+    def clear(self, *args, **kwargs):
+        self.cache.clear()
+
+json_cache = JSONCache()
+
+def encoded(row, fields=None):
+    """ the JSON representation of a Post, Comment or User, or of the given
+        fields of it, from the cache when the row has not changed since it
+        was last encoded
+    """
+    return json_cache.encoded(row, fields)
+
+def _splice(value):
+    if isinstance(value, Encoded):
+        return value.text
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (json.dumps(key), _splice(item))
+                                  for key, item in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_splice(item) for item in value)
+    return json.dumps(value)
+
+splice = timed('serialization')(_splice)
+
+def json_response(value):
+    """ like jsonify, but splices the Encoded values found in the value
+        without encoding them again.  The result is not pretty printed.
+    """
+    return current_app.response_class(splice(value),
+                                      mimetype='application/json')
+
+def init_app(app):
+    json_cache.init_app(app)
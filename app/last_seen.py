@@ -0,0 +1,105 @@
+import atexit
+import threading
+import time
+from . import db
+
+class LastSeenBuffer(object):
+    """ collects last_seen updates in memory and writes them behind.
+
+        Updates are coalesced per user, only the latest time is kept, and
+        written with one batched UPDATE once FLASKY_LAST_SEEN_BATCH users
+        are pending or the oldest pending update is FLASKY_LAST_SEEN_DELAY
+        seconds old.  Pending updates are also written when the process
+        exits.  The UPDATE never moves last_seen backwards, so buffers of
+        several workers can be flushed in any order.
+    """
+    def __init__(self):
+        self.app = None
+        self.batch = 500
+        self.delay = 60
+        self.pending = {}
+        self.since = None
+        self.thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.batch = app.config['FLASKY_LAST_SEEN_BATCH']
+        self.delay = app.config['FLASKY_LAST_SEEN_DELAY']
+
+    def record(self, user_id, when):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+            previous = self.pending.get(user_id)
+            if previous is None or previous < when:
+                self.pending[user_id] = when
+            if self.since is None:
+                self.since = time.time()
+            full = len(self.pending) >= self.batch
+        if full:
+            self._wakeup.set()
+
+    def discard(self, *args, **kwargs):
+        """ forget pending updates, for when the users table is dropped """
+        with self._lock:
+            self.pending = {}
+            self.since = None
+
+    def flush(self):
+        """ write every pending update, returns the number of users """
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+                self.since = None
+            if not pending or self.app is None:
+                return 0
+            try:
+                # no app context is pushed, popping it would remove the
+                # session of the request or test calling flush()
+                users = db.metadata.tables['users']
+                db.get_engine(self.app).execute(
+                    users.update().where(db.and_(
+                        users.c.id == db.bindparam('_id'),
+                        db.or_(users.c.last_seen == None,
+                               users.c.last_seen < db.bindparam('_when')))
+                    ).values(last_seen=db.bindparam('_when'),
+                             version=users.c.version + 1,
+                             updated_at=db.bindparam('_when')),
+                    [{'_id': id, '_when': when}
+                     for id, when in pending.items()])
+            except Exception:
+                # keep the updates for the next flush
+                for id, when in pending.items():
+                    self.record(id, when)
+                raise
+            return len(pending)
+
+    def _work(self):
+        while True:
+            since = self.since
+            timeout = self.delay
+            if since is not None:
+                timeout = max(0, since + self.delay - time.time())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            since = self.since
+            if since is None:
+                continue
+            if len(self.pending) >= self.batch or \
+                    time.time() - since >= self.delay:
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('Writing last_seen failed')
+                    time.sleep(min(self.delay, 5))
+
+last_seen_buffer = LastSeenBuffer()
+
+def init_app(app):
+    last_seen_buffer.init_app(app)
@@ -3,7 +3,7 @@ from flask import render_template, jsonify, request
 
 @main.app_errorhandler(403)
 def forbidden(e):
-    if request.accpet_mimetypes.accept_json and \
+    if request.accept_mimetypes.accept_json and \
             not request.accept_mimetypes.accept_html:
         response = jsonify({'error': 'forbidden'})
         response.status_code = 403
@@ -1,22 +1,28 @@
 from . import main
 from ..models import User, Post
-from flask import render_template, session, redirect, url_for, current_app, flash, abort, request, make_response
+from flask import render_template, session, redirect, url_for, current_app, flash, abort, request, make_response, g
 from threading import Thread
 from .forms import NameForm, EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
 from .. import db, mail
 from ..email import send_mail
-from ..models import Permission, Follow, Comment
+from ..models import Permission, Follow, Comment, with_authors
 from ..decorators import permission_required, admin_required
+from ..replicas import read_only
+from ..page_cache import cached_page
+from ..slow_queries import slow_query_log
 from flask.ext.login import login_required, current_user
 from flask.ext.sqlalchemy import get_debug_queries
 
 @main.after_app_request
 def after_request(response):
-    for query in get_debug_queries():
+    # the queries of earlier requests sharing the app context are skipped
+    for query in get_debug_queries()[g.get('first_query', 0):]:
         if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
             current_app.logger.warning(
                 'Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n' %
-                (query.statement, query.nParameters, query.duration, query.context))
+                (query.statement, query.parameters, query.duration, query.context))
+            slow_query_log.record(query.statement, query.parameters,
+                                  query.duration)
     return response
 
 @main.route('/shutdown')
@@ -51,10 +57,12 @@ def old_index():
                            known=session.get('known', False))
 
 @main.route('/user/<username>')
+@read_only
 def user(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         abort(404)
+    # every post has the same author, which is loaded already
     posts = user.posts.order_by(Post.timestamp.desc()).all()
     return render_template('user.html', user=user, posts=posts)
 
@@ -114,6 +122,8 @@ def edit_profile_admin(id):
     return render_template('edit_profile.html', form=form, user=user)
 
 @main.route('/', methods=['GET', 'POST'])
+@read_only
+@cached_page('posts')
 def index():
     form = PostForm()
     if form.validate_on_submit() and \
@@ -129,10 +139,10 @@ def index():
     if show_followed:
         query = current_user.followed_posts
     else:
-        query = Post.query
+        query = Post.query.order_by(Post.timestamp.desc())
 
     page = request.args.get('page', 1, type=int)
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
+    pagination = with_authors(query).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
@@ -143,8 +153,10 @@ def index():
                            showfollowed=show_followed)
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@read_only
+@cached_page('posts:{id}:comments')
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = with_authors(Post.query).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, 
@@ -155,9 +167,9 @@ def post(id):
         return redirect(url_for('.post', id=post.id, page=-1))
     page = request.args.get('page', 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) / \
+        page = (post.comment_count - 1) / \
                 current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(
+    pagination = with_authors(post.comments).order_by(
                     Comment.timestamp.desc()).paginate(
                         page=page, 
                         per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
@@ -192,7 +204,7 @@ def follow(username):
     if to_follow is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if current_user.is_following(to_follow):
+    if current_user.follow_exists(to_follow):
         flash('You are already following %s.' % username)
         return redirect(url_for('.user', username=username))
 
@@ -207,7 +219,7 @@ def unfollow(username):
     if to_unfollow is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if not current_user.is_following(to_unfollow):
+    if not current_user.follow_exists(to_unfollow):
         flash('You are not following %s.' % username)
         return redirect(url_for('.user', username=username))
     current_user.unfollow(to_unfollow)
@@ -268,7 +280,8 @@ def show_followed():
 @permission_required(Permission.MODERATE_COMMENTS)
 def moderate():
     page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
+    pagination = with_authors(Comment.query).order_by(
+        Comment.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
         error_out=False)
     comments = pagination.items
@@ -0,0 +1,251 @@
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request, Response, abort
+from flask.json import JSONEncoder
+from flask.ext.login import current_user
+from flask.ext.sqlalchemy import get_debug_queries
+from jinja2 import Template
+from . import db
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def timed(kind):
+    """ add the time spent in the decorated function to the current
+        request's time of the given kind
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not has_app_context() or 'metrics' not in g:
+                return f(*args, **kwargs)
+            # nested calls, like a template including another, count once
+            if g.metrics.get('in_' + kind):
+                return f(*args, **kwargs)
+            g.metrics['in_' + kind] = True
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                g.metrics[kind] += time.time() - start
+                g.metrics['in_' + kind] = False
+        return wrapped
+    return decorator
+
+class TimedTemplate(Template):
+    render = timed('template')(Template.render)
+
+class TimedJSONEncoder(JSONEncoder):
+    encode = timed('serialization')(JSONEncoder.encode)
+
+class Metrics(object):
+    """ request counts, latency histograms and gauges of this process.
+
+        When FLASKY_METRICS_DIR is set, every process saves its metrics to
+        a file of its own there, at most every FLASKY_METRICS_SYNC_INTERVAL
+        seconds and at exit, and the metrics endpoint adds up the files of
+        all processes, so any gunicorn worker can answer for all of them.
+        Counters of workers that exited are kept, gauges are only read
+        from live workers.
+    """
+    def __init__(self):
+        self.directory = None
+        self.interval = 5
+        self.requests = {}
+        self.histograms = {}
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._exit_registered = False
+
+    def init_app(self, app):
+        self.directory = app.config['FLASKY_METRICS_DIR']
+        self.interval = app.config['FLASKY_METRICS_SYNC_INTERVAL']
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if self.directory and not self._exit_registered:
+            atexit.register(self.save)
+            self._exit_registered = True
+
+    def observe(self, endpoint, method, status, durations):
+        with self._lock:
+            key = '%s|%s|%s' % (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for kind, duration in durations.items():
+                key = '%s|%s' % (kind, endpoint)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    # bucket counts, then the sum and the count
+                    histogram = self.histograms[key] = \
+                        [0] * len(BUCKETS) + [0.0, 0]
+                for i, bound in enumerate(BUCKETS):
+                    if duration <= bound:
+                        histogram[i] += 1
+                histogram[-2] += duration
+                histogram[-1] += 1
+        if self.directory and time.time() - self.saved > self.interval:
+            self.save()
+
+    def state(self):
+        with self._lock:
+            return {'pid': os.getpid(),
+                    'requests': dict(self.requests),
+                    'histograms': dict((key, list(value)) for key, value
+                                       in self.histograms.items()),
+                    'gauges': gauges()}
+
+    def path(self, pid):
+        return os.path.join(self.directory, 'metrics-%d.json' % pid)
+
+    def save(self):
+        self.saved = time.time()
+        if not self.directory:
+            return
+        state = self.state()
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp, self.path(state['pid']))
+
+    def collect(self):
+        """ the metrics of every process, with this one's up to date """
+        states = [self.state()]
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory,
+                                               'metrics-*.json')):
+                if path == self.path(os.getpid()):
+                    continue
+                try:
+                    with open(path) as f:
+                        state = json.load(f)
+                except (IOError, ValueError):
+                    continue
+                if not _alive(state['pid']):
+                    state['gauges'] = {}
+                states.append(state)
+        requests = {}
+        histograms = {}
+        gauge_totals = {}
+        for state in states:
+            for key, count in state['requests'].items():
+                requests[key] = requests.get(key, 0) + count
+            for key, values in state['histograms'].items():
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+            for name, value in state['gauges'].items():
+                gauge_totals[name] = gauge_totals.get(name, 0) + value
+        return requests, histograms, gauge_totals
+
+    def clear(self):
+        with self._lock:
+            self.requests = {}
+            self.histograms = {}
+
+metrics = Metrics()
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def gauges():
+    from .email import mail_queue_depth
+    values = {'flasky_mail_queue_depth': mail_queue_depth()}
+    pool = db.get_engine(current_app).pool if has_app_context() else None
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            values['flasky_db_pool_' + name] = getattr(pool, name)()
+    return values
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+def exposition():
+    """ the metrics in the Prometheus text exposition format """
+    requests, histograms, gauge_totals = metrics.collect()
+    lines = ['# HELP flasky_requests_total Requests by endpoint, method '
+             'and status.',
+             '# TYPE flasky_requests_total counter']
+    for key, count in sorted(requests.items()):
+        endpoint, method, status = key.split('|')
+        lines.append('flasky_requests_total%s %d' % (
+            _labels(endpoint=endpoint, method=method, status=status), count))
+    lines += ['# HELP flasky_request_duration_seconds Request latency, in '
+              'total and spent in the database, templates and serialization.',
+              '# TYPE flasky_request_duration_seconds histogram']
+    for key, values in sorted(histograms.items()):
+        kind, endpoint = key.split('|')
+        for bound, count in zip(BUCKETS, values):
+            lines.append('flasky_request_duration_seconds_bucket%s %d' % (
+                _labels(endpoint=endpoint, kind=kind, le=bound), count))
+        lines.append('flasky_request_duration_seconds_bucket%s %d' % (
+            _labels(endpoint=endpoint, kind=kind, le='+Inf'), values[-1]))
+        lines.append('flasky_request_duration_seconds_sum%s %f' % (
+            _labels(endpoint=endpoint, kind=kind), values[-2]))
+        lines.append('flasky_request_duration_seconds_count%s %d' % (
+            _labels(endpoint=endpoint, kind=kind), values[-1]))
+    for name, value in sorted(gauge_totals.items()):
+        lines += ['# TYPE %s gauge' % name, '%s %d' % (name, value)]
+    return '\n'.join(lines) + '\n'
+
+class MetricsMiddleware(object):
+    """ WSGI middleware timing every request from end to end """
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            return self.wsgi_app(environ, recording_start_response)
+        finally:
+            durations = environ.get('flasky.metrics', {})
+            durations['total'] = time.time() - start
+            metrics.observe(environ.get('flasky.endpoint') or 'unknown',
+                            environ.get('REQUEST_METHOD'),
+                            status[0] if status else '500', durations)
+
+def metrics_view():
+    token = current_app.config['FLASKY_METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != 'Bearer ' + token:
+            abort(403)
+    elif not current_user.is_administrator():
+        abort(403)
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    metrics.init_app(app)
+    app.jinja_env.template_class = TimedTemplate
+    app.json_encoder = TimedJSONEncoder
+    app.wsgi_app = MetricsMiddleware(app, app.wsgi_app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = {'template': 0.0, 'serialization': 0.0}
+
+    @app.after_request
+    def end_request_metrics(response):
+        if 'metrics' in g:
+            queries = get_debug_queries()[g.get('first_query', 0):]
+            request.environ['flasky.endpoint'] = request.endpoint
+            request.environ['flasky.metrics'] = {
+                'db': sum(query.duration for query in queries),
+                'template': g.metrics['template'],
+                'serialization': g.metrics['serialization']}
+        return response
@@ -3,11 +3,91 @@ from . import login_manager
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask.ext.login import UserMixin, AnonymousUserMixin
 from flask import current_app, request, url_for
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from datetime import datetime
+from collections import namedtuple
 import hashlib
-from markdown import markdown
-import bleach
+import threading
+import time
+from .rendering import render_post, render_comment, rerender
+from . import rendering
+from .cache import LRUCache
+from .commit_hooks import after_commit
+from .follow_index import follow_index
+from .last_seen import last_seen_buffer
+from .metrics import timed
+from .page_cache import page_cache
+from .fragments import fragment_cache
+from .json_cache import json_cache
+
+def _adjust_counter(connection, model, id, column, delta):
+    """ add delta to a denormalized counter column with an atomic UPDATE
+        issued on the flush connection, so it commits (or rolls back)
+        together with the row that triggered it
+    """
+    table = model.__table__
+    values = {column: table.c[column] + delta}
+    values.update(new_version(table))
+    connection.execute(table.update().where(table.c.id == id).values(values))
+
+def new_version(table):
+    """ the values moving a versioned row to its next version, for the
+        UPDATEs that go around the ORM
+    """
+    return {'version': table.c.version + 1, 'updated_at': datetime.utcnow()}
+
+def _bump_version(mapper, connection, target):
+    """ before_update handler giving a versioned row a new version whenever
+        one of its columns changes
+    """
+    if object_session(target).is_modified(target, include_collections=False):
+        target.version = mapper.class_.version + 1
+        target.updated_at = datetime.utcnow()
+
+def _check_counters(model, counters, repair=False):
+    """ compare each counter column against a correlated COUNT subquery,
+        returns a list of (id, column name, stored value, actual value)
+    """
+    counters = [(column, actual.correlate(model.__table__)
+                 .as_scalar().label(column.key + '_actual'))
+                for column, actual in counters]
+    columns = [model.id]
+    for column, actual in counters:
+        columns += [column, actual]
+    drifted = db.or_(*[db.func.coalesce(column, -1) != actual.element
+                       for column, actual in counters])
+    drift = []
+    for row in db.session.query(*columns).filter(drifted):
+        for i, (column, actual) in enumerate(counters):
+            stored, count = row[1 + 2 * i], row[2 + 2 * i]
+            if stored != count:
+                drift.append((row[0], column.key, stored, count))
+    if repair:
+        for id, name, stored, count in drift:
+            values = {name: count}
+            values.update(new_version(model.__table__))
+            model.query.filter_by(id=id).update(values,
+                                                synchronize_session=False)
+        db.session.commit()
+    return drift
+
+def with_authors(query):
+    """ eager load the author of every post or comment in a listing query,
+        together with the author's role, so that templates do not lazy load
+        them one row at a time.  to_json() only needs author_id.
+    """
+    return query.options(joinedload('author').joinedload('role'))
+
+def _to_json(row, fields):
+    """ the API representation of a row limited to the given fields, each
+        computed from only the columns the model lists for it
+    """
+    getters = type(row).JSON_FIELDS
+    return dict((field, getters[field][1](row)) for field in fields)
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -29,23 +109,117 @@ class Role(db.Model):
                          Permission.MODERATE_COMMENTS, False),
             'Administrator': (0xff, False)
         }
-        for r in roles:
-            role = Role.query.filter_by(name=r).first()
-            if role is None:
-                role = Role(name=r)
-            role.permissions = roles[r][0]
-            role.default = roles[r][1]
-            db.session.add(role)
+        # one executemany UPDATE for the roles that exist and one INSERT for
+        # the missing ones, whatever the number of roles
+        table = Role.__table__
+        existing = set(name for name, in db.session.execute(
+            db.select([table.c.name]).where(table.c.name.in_(list(roles)))))
+        updates = [{'_name': r, '_permissions': roles[r][0],
+                    '_default': roles[r][1]} for r in roles if r in existing]
+        inserts = [{'name': r, 'permissions': roles[r][0],
+                    'default': roles[r][1]} for r in roles if r not in existing]
+        if updates:
+            db.session.execute(table.update().where(
+                table.c.name == db.bindparam('_name')).values(
+                permissions=db.bindparam('_permissions'),
+                default=db.bindparam('_default')), updates)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
         db.session.commit()
+        # the statements above bypass the Role events
+        role_cache.bump()
 
     def __repr__(self):
         return '<Role %r>' % self.name
 
+RoleInfo = namedtuple('RoleInfo', ['id', 'name', 'permissions', 'default'])
+
+class RoleCache(object):
+    """ immutable in-memory snapshot of the roles table.
+
+        The snapshot is loaded on first use and replaced once it is older
+        than FLASKY_ROLE_CACHE_TTL seconds or when the version is bumped,
+        which happens whenever a role is written or the table is created.
+    """
+    def __init__(self):
+        self.version = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def bump(self, *args, **kwargs):
+        with self._lock:
+            self.version += 1
+
+    def roles(self):
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != self.version or \
+                time.time() - snapshot[1] > \
+                current_app.config['FLASKY_ROLE_CACHE_TTL']:
+            version = self.version
+            roles = dict((r.id, RoleInfo(r.id, r.name, r.permissions or 0,
+                                         bool(r.default)))
+                         for r in db.session.query(Role.id, Role.name,
+                                                   Role.permissions,
+                                                   Role.default))
+            snapshot = (version, time.time(), roles)
+            self._snapshot = snapshot
+        return snapshot[2]
+
+    def get(self, id):
+        return self.roles().get(id)
+
+    def default(self):
+        for role in self.roles().values():
+            if role.default:
+                return role
+
+    def with_permissions(self, permissions):
+        for role in self.roles().values():
+            if role.permissions == permissions:
+                return role
+
+role_cache = RoleCache()
+
+for name in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(Role, name, role_cache.bump)
+for name in ('after_create', 'after_drop'):
+    db.event.listen(Role.__table__, name, role_cache.bump)
+
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_follows_followed_id_timestamp', 'followed_id', 'timestamp'),
+        db.Index('ix_follows_follower_id_timestamp', 'follower_id', 'timestamp'),
+    )
+
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        _adjust_counter(connection, User, target.follower_id, 'followed_count', 1)
+        _adjust_counter(connection, User, target.followed_id, 'followers_count', 1)
+        Timeline.follow_added(connection, target.follower_id,
+                              target.followed_id)
+        follower_id, followed_id = target.follower_id, target.followed_id
+        # other requests only see the follow once it is committed
+        after_commit(object_session(target),
+                     lambda: follow_index.add(follower_id, followed_id))
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        _adjust_counter(connection, User, target.follower_id, 'followed_count', -1)
+        _adjust_counter(connection, User, target.followed_id, 'followers_count', -1)
+        Timeline.follow_removed(connection, target.follower_id,
+                                target.followed_id)
+        follower_id, followed_id = target.follower_id, target.followed_id
+        after_commit(object_session(target),
+                     lambda: follow_index.remove(follower_id, followed_id))
+
+db.event.listen(Follow, 'after_insert', Follow.on_inserted)
+db.event.listen(Follow, 'after_delete', Follow.on_deleted)
+for name in ('after_create', 'after_drop'):
+    db.event.listen(Follow.__table__, name, follow_index.invalidate)
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -61,7 +235,29 @@ class User(UserMixin, db.Model):
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
+    # denormalized counters, maintained by the Post and Follow events
+    post_count = db.Column(db.Integer, default=0)
+    followers_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
+    # followed authors over FLASKY_TIMELINE_FANOUT_LIMIT, whose posts are
+    # pulled at read time instead of being in the materialized timeline
+    large_followed_count = db.Column(db.Integer, default=0)
+    # bumped to revoke every auth token issued so far
+    token_generation = db.Column(db.Integer, default=0)
+    # bumped on every change, the API's ETags are derived from it
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime(), default=datetime.utcnow)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
+    # columns kept current by Core UPDATEs, so never taken from a snapshot
+    COUNTERS = ('post_count', 'followers_count', 'followed_count',
+                'large_followed_count')
+    VERSIONING = ('version', 'updated_at')
+    # columns the API checks credentials against, so that a change made in
+    # another process is seen at once and not after FLASKY_USER_CACHE_TTL
+    CREDENTIALS = ('email', 'password_hash', 'token_generation')
+    # columns whose changes do not invalidate cached snapshots
+    IDENTITY_VOLATILE = ('last_seen',) + COUNTERS + VERSIONING
     # users being followed by me
     followed = db.relationship('Follow',
                                foreign_keys=[Follow.follower_id],
@@ -78,11 +274,14 @@ class User(UserMixin, db.Model):
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        if self.role is None and self.role_id is None:
+            role = None
             if self.email == current_app.config['FLASKY_ADMIN']:
-                self.role = Role.query.filter_by(permissions=0xff).first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+                role = role_cache.with_permissions(0xff)
+            if role is None:
+                role = role_cache.default()
+            if role is not None:
+                self.role_id = role.id
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
         self.followed.append(Follow(followed=self))
@@ -96,11 +295,31 @@ class User(UserMixin, db.Model):
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(
-            Follow.follower_id == self.id)
+        return self.timeline()[0]
+
+    def timeline(self):
+        """ the posts by the users this user follows, newest first, together
+            with the (timestamp, id) columns the query is ordered by.
+
+            Posts are normally read from the materialized timelines table with
+            a single range scan over (user_id, timestamp).  Posts by authors
+            with a large fan-out are not pushed to their followers, so users
+            following one of them get the join of posts and follows instead.
+        """
+        if self.large_followed_count:
+            keys = (Post.timestamp, Post.id)
+            query = Post.query.join(
+                Follow, Follow.followed_id == Post.author_id).filter(
+                Follow.follower_id == self.id)
+        else:
+            keys = (Timeline.timestamp, Timeline.post_id)
+            query = Post.query.join(
+                Timeline, Timeline.post_id == Post.id).filter(
+                Timeline.user_id == self.id)
+        return query.order_by(keys[0].desc(), keys[1].desc()), keys
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self.follow_exists(user):
             f = Follow(follower_id=self.id, followed_id=user.id)
             db.session.add(f)
 
@@ -109,11 +328,30 @@ class User(UserMixin, db.Model):
         if f:
             db.session.delete(f)
 
+    def follow_exists(self, user):
+        """ whether this user follows user, asked to the database for the
+            write paths: the follow index of this process may be behind
+            the follows written by others
+        """
+        exists = self.followed.filter_by(followed_id=user.id).first() \
+            is not None
+        if exists != follow_index.is_following(self.id, user.id):
+            # the answer may come from this transaction, so the index is
+            # only corrected once it commits
+            change = follow_index.add if exists else follow_index.remove
+            follower_id, followed_id = self.id, user.id
+            after_commit(db.session,
+                         lambda: change(follower_id, followed_id))
+        return exists
+
     def is_following(self, user):
-        return self.followed.filter_by(followed_id=user.id).first() is not None
+        """ whether this user follows user, from the follow index, for
+            rendering; follows show there once they are committed
+        """
+        return follow_index.is_following(self.id, user.id)
 
     def is_followed_by(self, user):
-        return self.followers.filter_by(follower_id=user.id).first() is not None
+        return follow_index.is_following(user.id, self.id)
 
     @staticmethod
     def generate_fake(count=100):
@@ -140,8 +378,27 @@ class User(UserMixin, db.Model):
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def permissions(self):
+        """ the permission bits of the user's role, looked up in the role
+            cache and memoized on the instance, which lives for one request
+        """
+        key = (self.role_id, role_cache.version)
+        memo = self.__dict__.get('_permissions')
+        if memo is None or memo[0] != key:
+            if self.role_id is not None:
+                role = role_cache.get(self.role_id)
+            else:
+                # a role assigned to a user that has not been flushed yet
+                role = self.__dict__.get('role')
+            permissions = 0
+            if role is not None and role.permissions is not None:
+                permissions = role.permissions
+            memo = (key, permissions)
+            self._permissions = memo
+        return memo[1]
+
     def can(self, permissions):
-        return self.role is not None and (self.role.permissions & permissions) == permissions
+        return (self.permissions() & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
@@ -217,21 +474,41 @@ class User(UserMixin, db.Model):
     def generate_auth_token(self, expiration=3600):
         s = Serializer(current_app.config['SECRET_KEY'],
                        expires_in=expiration)
-        return s.dumps({'id': self.id})
+        return s.dumps({'id': self.id,
+                        'generation': self.token_generation or 0})
+
+    def revoke_auth_tokens(self):
+        self.token_generation = (self.token_generation or 0) + 1
+        db.session.add(self)
 
-    # static method as the user will be known only after the token is decoded
     @staticmethod
-    def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
+    def load_auth_token(token):
+        """ returns the (id, generation, expires) of a valid token or None,
+            expires is the time the token expires at
+        """
         try:
-            data = s.loads(token)
+            data, header = _token_serializer().loads(token,
+                                                     return_header=True)
+            return data['id'], data.get('generation', 0), header['exp']
         except:
             return None
-        return User.query.get(data['id'])
+
+    # static method as the user will be known only after the token is decoded
+    @staticmethod
+    def verify_auth_token(token):
+        data = User.load_auth_token(token)
+        if data is None:
+            return None
+        user = cached_user(data[0])
+        if user is None or (user.token_generation or 0) != data[1]:
+            return None
+        return user
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+        """ record the visit, the row is updated later in a batch """
+        now = datetime.utcnow()
+        set_committed_value(self, 'last_seen', now)
+        last_seen_buffer.record(self.id, now)
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -243,30 +520,185 @@ class User(UserMixin, db.Model):
             url=url, hash=hash, size=size, default=default, rating=rating)
 
     @staticmethod
-    def add_self_follows():
-        for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
-                db.session.add(user)
-                db.session.commit()
+    def check_counters(repair=False):
+        posts = db.select([db.func.count(Post.id)]).where(
+            Post.author_id == User.id)
+        followers = db.select([db.func.count()]).select_from(Follow).where(
+            Follow.followed_id == User.id)
+        followed = db.select([db.func.count()]).select_from(Follow).where(
+            Follow.follower_id == User.id)
+        return _check_counters(User, [(User.post_count, posts),
+                                      (User.followers_count, followers),
+                                      (User.followed_count, followed),
+                                      (User.large_followed_count,
+                                       Timeline.large_followed())],
+                               repair=repair)
 
-    def to_json(self):
-        json_user = {
-            'url': url_for('api.get_post',
-                           id=self.id,
-                           _external=True),
-            'username': self.username,
-            'member_since': self.member_since,
-            'last_seen': self.last_seen,
-            'posts': url_for('api.get_user_posts',
-                             id=self.id,
-                             _external=True),
-            'followed_posts': url_for('api.get_user_followed_posts',
-                                      id=self.id,
-                                      _external=True),
-            'post_count': self.posts.count()
-        }
-        return json_user
+    @staticmethod
+    def add_self_follows(chunk_size=10000):
+        """ make every user follow themselves.
+
+            Users are processed in ranges of chunk_size ids, each with one
+            INSERT ... SELECT of the users without a self-follow, followed by
+            a recount of the follow counters and a backfill of the users' own
+            posts into their timelines, and a commit.  Returns the number of
+            follows added.
+        """
+        users = User.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        timelines = Timeline.__table__
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        now = db.literal(datetime.utcnow(), db.DateTime)
+        last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+        added = 0
+        for first_id in range(1, last_id + 1, chunk_size):
+            in_chunk = users.c.id.between(first_id, first_id + chunk_size - 1)
+            result = db.session.execute(follows.insert().from_select(
+                ['follower_id', 'followed_id', 'timestamp'],
+                db.select([users.c.id.label('follower_id'),
+                           users.c.id.label('followed_id'), now]).where(db.and_(
+                    in_chunk, ~db.exists().where(db.and_(
+                        follows.c.follower_id == users.c.id,
+                        follows.c.followed_id == users.c.id)).correlate(
+                        users)))))
+            if result.rowcount:
+                added += result.rowcount
+                db.session.execute(users.update().where(in_chunk).values(
+                    followers_count=db.select([db.func.count()]).select_from(
+                        follows).where(
+                        follows.c.followed_id == users.c.id).as_scalar(),
+                    followed_count=db.select([db.func.count()]).select_from(
+                        follows).where(
+                        follows.c.follower_id == users.c.id).as_scalar()))
+                db.session.execute(timelines.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    db.select([posts.c.author_id, posts.c.id,
+                               posts.c.timestamp]).select_from(posts.join(
+                        users, users.c.id == posts.c.author_id)).where(db.and_(
+                        in_chunk,
+                        db.func.coalesce(users.c.followers_count, 0) <= limit,
+                        ~db.exists().where(db.and_(
+                            timelines.c.user_id == posts.c.author_id,
+                            timelines.c.post_id == posts.c.id)).correlate(
+                            posts)))))
+            db.session.commit()
+        if added:
+            # the self-follows may have pushed authors over the limit
+            Timeline.recount_large_followed()
+            db.session.commit()
+        # the statements above bypass the Follow events
+        follow_index.invalidate()
+        return added
+
+    # the fields of the API representation: the columns each one needs and
+    # how it is computed
+    JSON_FIELDS = {
+        'id': (('id',), lambda user: user.id),
+        'url': (('id',), lambda user: url_for('api.get_post',
+                                              id=user.id,
+                                              _external=True)),
+        'username': (('username',), lambda user: user.username),
+        'member_since': (('member_since',), lambda user: user.member_since),
+        'last_seen': (('last_seen',), lambda user: user.last_seen),
+        'posts': (('id',), lambda user: url_for('api.get_user_posts',
+                                                id=user.id,
+                                                _external=True)),
+        'followed_posts': (('id',), lambda user: url_for(
+            'api.get_user_followed_posts', id=user.id, _external=True)),
+        'post_count': (('post_count',), lambda user: user.post_count),
+    }
+    JSON_DEFAULT = ('url', 'username', 'member_since', 'last_seen', 'posts',
+                    'followed_posts', 'post_count')
+    # loaded whatever the fields, for ETags and pagination
+    JSON_COLUMNS = ('id', 'version', 'updated_at')
+
+    @timed('serialization')
+    def to_json(self, fields=None):
+        return _to_json(self, fields or User.JSON_DEFAULT)
+
+    @staticmethod
+    def snapshot(id):
+        """ the user loaded in a throwaway session and detached from it """
+        session = db.create_session({})
+        try:
+            return session.query(User).get(id)
+        finally:
+            session.close()
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        json_cache.forget_on_commit(object_session(target), target)
+        state = inspect(target)
+        for attr in mapper.column_attrs:
+            if attr.key not in User.IDENTITY_VOLATILE and \
+                    state.attrs[attr.key].history.has_changes():
+                forget_identity(target)
+                page_cache.invalidate_on_commit(object_session(target),
+                                                'users:%d' % target.id)
+                break
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        forget_identity(target)
+        json_cache.forget_on_commit(object_session(target), target)
+        page_cache.invalidate_on_commit(object_session(target),
+                                        'users:%d' % target.id)
+
+db.event.listen(User, 'before_update', _bump_version)
+db.event.listen(User, 'after_update', User.on_updated)
+db.event.listen(User, 'after_delete', User.on_deleted)
+
+# detached snapshots of recently seen users, keyed by id
+identity_cache = LRUCache(maxsize=10000)
+
+def forget_identity(user):
+    """ drop the cached snapshot of user now and again once the change
+        is committed, so a concurrent load cannot put the old row back
+    """
+    identity_cache.pop(user.id)
+    session = object_session(user)
+    if session is not None:
+        after_commit(session, lambda: identity_cache.pop(user.id))
+
+def cached_user(id):
+    """ the user with id, resolved from a cached snapshot which is merged
+        into the session without a query.  Snapshots live for
+        FLASKY_USER_CACHE_TTL seconds and are dropped when the user changes.
+    """
+    user = db.session.identity_map.get(identity_key(User, id))
+    if user is not None:
+        return user
+    snapshot = identity_cache.get(id)
+    if snapshot is None:
+        snapshot = User.snapshot(id)
+        if snapshot is None:
+            return None
+        identity_cache.set(id, snapshot,
+                           ttl=current_app.config['FLASKY_USER_CACHE_TTL'])
+    user = db.session.merge(snapshot, load=False)
+    # the counters, the version and the credentials are loaded together by
+    # primary key on first access
+    db.session.expire(user, User.COUNTERS + User.VERSIONING +
+                      User.CREDENTIALS)
+    return user
+
+_token_serializers = {}
+
+def _token_serializer():
+    """ the serializer verifying auth tokens, built once per secret key """
+    key = current_app.config['SECRET_KEY']
+    s = _token_serializers.get(key)
+    if s is None:
+        s = _token_serializers[key] = Serializer(key)
+    return s
+
+def _clear_identities(*args, **kwargs):
+    identity_cache.clear()
+
+for name in ('after_create', 'after_drop'):
+    db.event.listen(User.__table__, name, _clear_identities)
+db.event.listen(User.__table__, 'after_drop', last_seen_buffer.discard)
 
 from app.exceptions import ValidationError
 
@@ -277,7 +709,14 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     body_html = db.Column(db.Text)
+    comment_count = db.Column(db.Integer, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
+    __table_args__ = (
+        db.Index('ix_posts_author_id_timestamp', 'author_id', 'timestamp'),
+    )
 
     @staticmethod
     def generate_fake(count=100, testing=False):
@@ -305,36 +744,40 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if value == oldvalue and target.body_html is not None:
+            return
+        if current_app.config['FLASKY_ASYNC_RENDERING']:
+            rendering.defer(target)
+        else:
+            target.body_html = render_post(value)
 
     @staticmethod
     def update_body_html():
-        all_posts = Post.query.all()
-        for post in all_posts:
-            post.body = post.body
-            db.session.add(post)
-        db.session.commit()
+        rerender(Post, processes=1, output=lambda message: None)
 
-    def to_json(self):
-        json_post = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user',
-                              id=self.author_id,
-                              _external=True),
-            'comments': url_for('api.get_post_comments',
-                                id=self.id,
-                                _external=True),
-            'comment_count': self.comments.count()
-        }
-        return json_post
+    JSON_FIELDS = {
+        'id': (('id',), lambda post: post.id),
+        'url': (('id',), lambda post: url_for('api.get_post', id=post.id,
+                                              _external=True)),
+        'body': (('body',), lambda post: post.body),
+        'body_html': (('body_html',), lambda post: post.body_html),
+        'timestamp': (('timestamp',), lambda post: post.timestamp),
+        'author': (('author_id',), lambda post: url_for('api.get_user',
+                                                        id=post.author_id,
+                                                        _external=True)),
+        'comments': (('id',), lambda post: url_for('api.get_post_comments',
+                                                   id=post.id,
+                                                   _external=True)),
+        'comment_count': (('comment_count',),
+                          lambda post: post.comment_count),
+    }
+    JSON_DEFAULT = ('url', 'body', 'body_html', 'timestamp', 'author',
+                    'comments', 'comment_count')
+    JSON_COLUMNS = ('id', 'version', 'updated_at', 'timestamp')
+
+    @timed('serialization')
+    def to_json(self, fields=None):
+        return _to_json(self, fields or Post.JSON_DEFAULT)
 
     @staticmethod
     def from_json(json_post):
@@ -343,7 +786,224 @@ class Post(db.Model):
             raise ValidationError('post does not have a body')
         return Post(body=body)
 
+    @staticmethod
+    def check_counters(repair=False):
+        comments = db.select([db.func.count(Comment.id)]).where(
+            Comment.post_id == Post.id)
+        return _check_counters(Post, [(Post.comment_count, comments)],
+                               repair=repair)
+
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        if target.author_id is not None:
+            _adjust_counter(connection, User, target.author_id, 'post_count', 1)
+            Timeline.fan_out(connection, target)
+        rendering.schedule(target)
+        page_cache.invalidate_on_commit(object_session(target), 'posts')
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        rendering.schedule(target)
+        page_cache.invalidate_on_commit(object_session(target),
+                                        'posts:%d' % target.id)
+        json_cache.forget_on_commit(object_session(target), target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        if target.author_id is not None:
+            _adjust_counter(connection, User, target.author_id, 'post_count', -1)
+        page_cache.invalidate_on_commit(object_session(target), 'posts',
+                                        'posts:%d' % target.id)
+        json_cache.forget_on_commit(object_session(target), target)
+        timelines = Timeline.__table__
+        connection.execute(timelines.delete().where(
+            timelines.c.post_id == target.id))
+
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_insert', Post.on_inserted)
+db.event.listen(Post, 'before_update', _bump_version)
+db.event.listen(Post, 'after_update', Post.on_updated)
+db.event.listen(Post, 'after_delete', Post.on_deleted)
+
+class Timeline(db.Model):
+    """ materialized home timelines: one row for every post in the
+        timeline of every follower of its author, filled on write
+    """
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+    @staticmethod
+    def _followers_count(connection, user_id):
+        users = User.__table__
+        return connection.execute(db.select([users.c.followers_count]).where(
+            users.c.id == user_id)).scalar() or 0
+
+    @staticmethod
+    def is_large_fan_out(connection, user_id):
+        return Timeline._followers_count(connection, user_id) > \
+            current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def _count_large_followed(connection, where, delta):
+        users = User.__table__
+        connection.execute(users.update().where(where).values(
+            large_followed_count=db.func.coalesce(
+                users.c.large_followed_count, 0) + delta))
+
+    @staticmethod
+    def follow_added(connection, follower_id, followed_id):
+        """ once a follow and its counters are written, copy the posts of the
+            followed user into the follower's timeline, or count the author
+            as pulled at read time when it is over the fan-out limit
+        """
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        followers = Timeline._followers_count(connection, followed_id)
+        if followers <= limit:
+            Timeline.backfill(connection, follower_id, followed_id)
+        elif followers == limit + 1:
+            Timeline.pull(connection, followed_id)
+        else:
+            Timeline._count_large_followed(
+                connection, User.__table__.c.id == follower_id, 1)
+
+    @staticmethod
+    def follow_removed(connection, follower_id, followed_id):
+        """ once a follow is deleted and its counters are written, remove the
+            posts of the unfollowed user from the timeline
+        """
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        followers = Timeline._followers_count(connection, followed_id)
+        Timeline.trim(connection, follower_id, followed_id)
+        if followers >= limit:
+            Timeline._count_large_followed(
+                connection, User.__table__.c.id == follower_id, -1)
+        if followers == limit:
+            Timeline.push(connection, followed_id)
+
+    @staticmethod
+    def pull(connection, author_id):
+        """ an author just went over the fan-out limit: remove its posts from
+            the timelines, its followers pull them at read time from now on
+        """
+        timelines = Timeline.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        connection.execute(timelines.delete().where(
+            timelines.c.post_id.in_(db.select([posts.c.id]).where(
+                posts.c.author_id == author_id))))
+        Timeline._count_large_followed(
+            connection, User.__table__.c.id.in_(
+                db.select([follows.c.follower_id]).where(
+                    follows.c.followed_id == author_id)), 1)
+
+    @staticmethod
+    def push(connection, author_id):
+        """ an author just went back under the fan-out limit: materialize
+            its posts, including those written while it was over the limit,
+            in the timelines of its followers
+        """
+        timelines = Timeline.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        connection.execute(timelines.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([follows.c.follower_id, posts.c.id, posts.c.timestamp])
+            .select_from(follows.join(
+                posts, posts.c.author_id == follows.c.followed_id))
+            .where(db.and_(
+                follows.c.followed_id == author_id,
+                ~db.exists().where(db.and_(
+                    timelines.c.user_id == follows.c.follower_id,
+                    timelines.c.post_id == posts.c.id)).correlate(
+                    follows, posts)))))
+        Timeline._count_large_followed(
+            connection, User.__table__.c.id.in_(
+                db.select([follows.c.follower_id]).where(
+                    follows.c.followed_id == author_id)), -1)
+
+    @staticmethod
+    def large_followed():
+        """ a COUNT of the followed authors over the fan-out limit, to be
+            correlated to the users table
+        """
+        users = User.__table__
+        followed = users.alias('followed')
+        follows = Follow.__table__
+        return db.select([db.func.count()]).select_from(follows.join(
+            followed, followed.c.id == follows.c.followed_id)).where(db.and_(
+            follows.c.follower_id == users.c.id,
+            db.func.coalesce(followed.c.followers_count, 0) >
+            current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']))
+
+    @staticmethod
+    def recount_large_followed():
+        users = User.__table__
+        db.session.execute(users.update().values(
+            large_followed_count=Timeline.large_followed().correlate(
+                users).as_scalar()))
+
+    @staticmethod
+    def fan_out(connection, post):
+        """ push a new post to the timelines of all the author's followers,
+            authors with too many followers are left to the pull query
+        """
+        if Timeline.is_large_fan_out(connection, post.author_id):
+            return
+        follows = Follow.__table__
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([follows.c.follower_id,
+                       db.literal(post.id),
+                       db.literal(post.timestamp)]).where(
+                follows.c.followed_id == post.author_id)))
+
+    @staticmethod
+    def backfill(connection, follower_id, followed_id):
+        """ copy the posts of a newly followed user into the timeline """
+        if Timeline.is_large_fan_out(connection, followed_id):
+            return
+        posts = Post.__table__
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([db.literal(follower_id), posts.c.id,
+                       posts.c.timestamp]).where(
+                posts.c.author_id == followed_id)))
+
+    @staticmethod
+    def trim(connection, follower_id, followed_id):
+        """ remove the posts of an unfollowed user from the timeline """
+        timelines = Timeline.__table__
+        posts = Post.__table__
+        connection.execute(timelines.delete().where(db.and_(
+            timelines.c.user_id == follower_id,
+            timelines.c.post_id.in_(db.select([posts.c.id]).where(
+                posts.c.author_id == followed_id)))))
+
+    @staticmethod
+    def rebuild():
+        """ repopulate every timeline from the follows and posts tables, to be
+            run after FLASKY_TIMELINE_FANOUT_LIMIT is changed
+        """
+        timelines = Timeline.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        users = User.__table__
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        db.session.execute(timelines.delete())
+        db.session.execute(timelines.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([follows.c.follower_id, posts.c.id, posts.c.timestamp])
+            .select_from(follows.join(
+                posts, posts.c.author_id == follows.c.followed_id).join(
+                users, users.c.id == follows.c.followed_id))
+            .where(db.func.coalesce(users.c.followers_count, 0) <= limit)))
+        Timeline.recount_large_followed()
+        db.session.commit()
 
 class Comment(db.Model):
     __tablename__ = 'comments'
@@ -354,6 +1014,12 @@ class Comment(db.Model):
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+    )
 
     """ pick a random post from each user and pick one of the
         user's post to gerenate fake comments. A default of 100
@@ -361,11 +1027,7 @@ class Comment(db.Model):
     """
     @staticmethod
     def update_body_html():
-        comments = Comment.query.all()
-        for comment in comments:
-            comment.body = comment.body
-            db.session.add(comment)
-        db.session.commit()
+        rerender(Comment, processes=1, output=lambda message: None)
 
     @staticmethod
     def generate_fake(count=100, testing=False):
@@ -399,24 +1061,71 @@ class Comment(db.Model):
                     db.session.rollback()
 
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
-        target.body_html = bleach.linkify(
-            bleach.clean(
-                markdown(value, output_format='html'),
-                tags=allowed_tags,
-                strip=True))
-
-    def to_json(self):
-        return {'body': self.body,
-                'body_html': self.body_html,
-                'timestamp': self.timestamp,
-                'author' : url_for('api.get_user',
-                                   id=self.author_id,
-                                   _external=True),
-
-                }
+        if value == oldvalue and target.body_html is not None:
+            return
+        if current_app.config['FLASKY_ASYNC_RENDERING']:
+            rendering.defer(target)
+        else:
+            target.body_html = render_comment(value)
+
+    JSON_FIELDS = {
+        'id': (('id',), lambda comment: comment.id),
+        'body': (('body',), lambda comment: comment.body),
+        'body_html': (('body_html',), lambda comment: comment.body_html),
+        'timestamp': (('timestamp',), lambda comment: comment.timestamp),
+        'author': (('author_id',), lambda comment: url_for(
+            'api.get_user', id=comment.author_id, _external=True)),
+    }
+    JSON_DEFAULT = ('body', 'body_html', 'timestamp', 'author')
+    JSON_COLUMNS = ('id', 'version', 'updated_at', 'timestamp')
+
+    @timed('serialization')
+    def to_json(self, fields=None):
+        return _to_json(self, fields or Comment.JSON_DEFAULT)
+
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        if target.post_id is not None:
+            _adjust_counter(connection, Post, target.post_id, 'comment_count', 1)
+        rendering.schedule(target)
+        Comment.invalidate_pages(target)
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        rendering.schedule(target)
+        page_cache.invalidate_on_commit(object_session(target),
+                                        'comments:%d' % target.id)
+        json_cache.forget_on_commit(object_session(target), target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        if target.post_id is not None:
+            _adjust_counter(connection, Post, target.post_id, 'comment_count', -1)
+        Comment.invalidate_pages(target)
+        json_cache.forget_on_commit(object_session(target), target)
+
+    @staticmethod
+    def invalidate_pages(target):
+        # the comments of the post and its comment count changed
+        tags = ['comments:%d' % target.id]
+        if target.post_id is not None:
+            tags += ['posts:%d' % target.post_id,
+                     'posts:%d:comments' % target.post_id]
+        page_cache.invalidate_on_commit(object_session(target), *tags)
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_inserted)
+db.event.listen(Comment, 'before_update', _bump_version)
+db.event.listen(Comment, 'after_update', Comment.on_updated)
+db.event.listen(Comment, 'after_delete', Comment.on_deleted)
+def _clear_caches(*args, **kwargs):
+    page_cache.clear()
+    fragment_cache.clear()
+    json_cache.clear()
+
+for table in (User.__table__, Post.__table__, Comment.__table__):
+    for name in ('after_create', 'after_drop'):
+        db.event.listen(table, name, _clear_caches)
 
 class Permission:
     FOLLOW = 0x01
@@ -434,6 +1143,6 @@ class AnonymousUser(AnonymousUserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return cached_user(int(user_id))
 
 login_manager.anonymous_user = AnonymousUser
@@ -0,0 +1,235 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial, wraps
+from flask import g, has_app_context, make_response, request, session
+from flask.ext.login import current_user
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import mapper
+from . import db
+from .commit_hooks import after_commit
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+class PageCache(object):
+    """ per process cache of the pages served to anonymous visitors.
+
+        Every page is stored with the tags of what it shows: 'posts:12'
+        for each row loaded while rendering it and the tags given by the
+        view, like 'posts' for the list of all posts.  The model events
+        invalidate the tags of the rows they write once the transaction
+        commits.  Invalidated or expired pages are kept as stale for
+        FLASKY_PAGE_CACHE_STALE seconds: the first request for a stale page
+        regenerates it while the others get the stale copy, and requests
+        for a page being rendered for the first time wait for it, so a
+        page is never regenerated by several requests at once.
+
+        The invalidations only reach the cache of the process committing
+        the write.  Other worker processes keep serving their copy until
+        it expires, so a page may show a write FLASKY_PAGE_CACHE_TTL
+        seconds late, plus the time taken by the request regenerating it.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.ttl = 0
+        self.stale = 0
+        self.wait_timeout = 0
+        self.hits = 0
+        self.misses = 0
+        # key: [body, fresh until, stale until, tags]
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        # keys being regenerated, with the event set when they are done
+        self._pending = {}
+        self._generation = 0
+        # (generation, tags) of the latest invalidations
+        self._invalidated = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config['FLASKY_PAGE_CACHE_TTL']
+        self.stale = app.config['FLASKY_PAGE_CACHE_STALE']
+        self.wait_timeout = app.config['FLASKY_PAGE_CACHE_WAIT']
+
+    def get(self, key):
+        """ returns (body, fresh) or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[2] < time.time():
+                if entry is not None:
+                    self._untag(key, entry[3])
+                return None
+            self._entries[key] = entry
+            return entry[0], entry[1] >= time.time()
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def begin(self, key):
+        """ claim the regeneration of a page, returns the current generation
+            or None when another request has claimed it already
+        """
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending[key] = threading.Event()
+            return self._generation
+
+    def wait(self, key):
+        """ wait for the request regenerating the page to be done """
+        event = self._pending.get(key)
+        if event is not None:
+            event.wait(self.wait_timeout)
+
+    def end(self, key):
+        with self._lock:
+            event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def set(self, key, body, tags, generation):
+        now = time.time()
+        with self._lock:
+            # a write committed while the page was rendered may be missing
+            # from it, so it is only good as a stale copy
+            fresh = now + self.ttl
+            if generation != self._generation:
+                if not self._invalidated or \
+                        self._invalidated[0][0] > generation + 1:
+                    fresh = 0
+                for invalidated, invalidated_tags in self._invalidated:
+                    if invalidated > generation and \
+                            not invalidated_tags.isdisjoint(tags):
+                        fresh = 0
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._untag(key, old[3])
+            self._entries[key] = [body, fresh, now + self.ttl + self.stale,
+                                  tags]
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, old = self._entries.popitem(last=False)
+                self._untag(old_key, old[3])
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def invalidate(self, *tags):
+        """ turn the pages showing any of the tags stale """
+        with self._lock:
+            self._generation += 1
+            self._invalidated.append((self._generation, frozenset(tags)))
+            for tag in tags:
+                for key in self._keys_by_tag.get(tag, ()):
+                    self._entries[key][1] = 0
+
+    def invalidate_on_commit(self, session, *tags):
+        after_commit(session, partial(self.invalidate, *tags))
+
+    def clear(self, *args, **kwargs):
+        with self._lock:
+            self._generation += 1
+            self._invalidated.clear()
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+page_cache = PageCache()
+
+def _tag(key):
+    table = getattr(key[0], '__tablename__', None)
+    if table is not None and len(key[1]) == 1:
+        return '%s:%s' % (table, key[1][0])
+
+def _on_load(target, *args):
+    if not has_app_context():
+        return
+    tags = g.get('page_cache_tags')
+    if tags is not None:
+        tags.add(_tag(inspect(target).key))
+
+# the rows loaded while a cached page is rendered, most are gone from the
+# session by the time the view returns
+event.listen(mapper, 'load', _on_load)
+event.listen(mapper, 'refresh', _on_load)
+
+def _loaded_tags():
+    """ the tags of every row loaded while the view ran, or still in the
+        session from before
+    """
+    tags = g.get('page_cache_tags') or set()
+    tags.update(_tag(key) for key in list(db.session.identity_map.keys()))
+    tags.discard(None)
+    return tags
+
+def _cacheable():
+    return request.method == 'GET' and page_cache.ttl and \
+        not current_user.is_authenticated() and '_flashes' not in session
+
+def _cached(body, status):
+    response = make_response(body)
+    response.headers['X-Page-Cache'] = status
+    return response
+
+def cached_page(*view_tags):
+    """ cache the page for anonymous visitors, keyed by endpoint, view
+        arguments and page number.  The tags may use the view arguments,
+        like 'posts:{id}:comments'.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not _cacheable():
+                return f(*args, **kwargs)
+            key = (request.endpoint, tuple(sorted(kwargs.items())),
+                   request.args.get('page', 1, type=int), request.is_secure)
+            entry = page_cache.get(key)
+            if entry is not None and entry[1]:
+                page_cache.count(True)
+                return _cached(entry[0], 'hit')
+            generation = page_cache.begin(key)
+            if generation is None:
+                if entry is not None:
+                    # somebody else is regenerating it already
+                    page_cache.count(True)
+                    return _cached(entry[0], 'stale')
+                page_cache.wait(key)
+                entry = page_cache.get(key)
+                if entry is not None:
+                    page_cache.count(True)
+                    return _cached(entry[0], 'hit')
+                page_cache.count(False)
+                return f(*args, **kwargs)
+            page_cache.count(False)
+            try:
+                g.page_cache_tags = set()
+                rv = f(*args, **kwargs)
+                if isinstance(rv, string_types):
+                    tags = _loaded_tags()
+                    tags.update(tag.format(**kwargs) for tag in view_tags)
+                    page_cache.set(key, rv, tags, generation)
+                    return _cached(rv, 'miss')
+                return rv
+            finally:
+                g.page_cache_tags = None
+                page_cache.end(key)
+        return wrapped
+    return decorator
+
+def init_app(app):
+    page_cache.init_app(app)
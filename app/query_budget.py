@@ -0,0 +1,67 @@
+import threading
+from flask import current_app, g, request
+from flask.ext.sqlalchemy import get_debug_queries
+from .exceptions import QueryBudgetExceeded
+
+class QueryStats(object):
+    """ per endpoint totals of the queries issued by requests """
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, count):
+        with self._lock:
+            stats = self.endpoints.setdefault(
+                endpoint, {'requests': 0, 'queries': 0, 'max': 0})
+            stats['requests'] += 1
+            stats['queries'] += count
+            stats['max'] = max(stats['max'], count)
+
+    def clear(self):
+        with self._lock:
+            self.endpoints = {}
+
+query_stats = QueryStats()
+
+def repeated_statements(queries, threshold):
+    """ the statements run with threshold or more different parameters,
+        the signature of a lazy load issued once per row (N+1)
+    """
+    parameters = {}
+    for query in queries:
+        parameters.setdefault(query.statement, set()).add(
+            repr(query.parameters))
+    return sorted((len(p), statement) for statement, p in parameters.items()
+                  if len(p) >= threshold)
+
+def budget(endpoint):
+    return current_app.config['FLASKY_QUERY_BUDGETS'].get(
+        endpoint, current_app.config['FLASKY_QUERY_BUDGET'])
+
+def init_app(app):
+    @app.before_request
+    def start_query_budget():
+        # the app context, and so the recorded queries, can outlive a request
+        g.first_query = len(get_debug_queries())
+
+    @app.after_request
+    def check_query_budget(response):
+        if request.endpoint is None or 'first_query' not in g:
+            return response
+        queries = get_debug_queries()[g.first_query:]
+        query_stats.add(request.endpoint, len(queries))
+        problems = []
+        limit = budget(request.endpoint)
+        if len(queries) > limit:
+            problems.append('%d queries, the budget is %d' %
+                            (len(queries), limit))
+        for count, statement in repeated_statements(
+                queries, current_app.config['FLASKY_N_PLUS_ONE_THRESHOLD']):
+            problems.append('N+1: %d runs of %s' % (count, statement))
+        if problems:
+            message = '%s %s: %s' % (request.method, request.endpoint,
+                                     '\n'.join(problems))
+            if current_app.config['FLASKY_QUERY_BUDGET_RAISE']:
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
@@ -0,0 +1,307 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+from markdown import markdown
+import bleach
+from sqlalchemy.orm import object_session
+from . import db
+from .cache import LRUCache
+from .commit_hooks import after_commit
+from .page_cache import page_cache
+
+# bump whenever a change to the pipeline below changes its output, so that
+# renders cached by the previous version are not reused
+RENDERER_VERSION = 1
+
+POST_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+             'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+             'h1', 'h2', 'h3', 'p']
+COMMENT_TAGS = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
+
+class RenderCache(object):
+    """ content addressed cache of rendered bodies.
+
+        Renders are keyed by a hash of the renderer version, the allowed tags
+        profile and the markdown source, so identical bodies are rendered only
+        once.  The memory tier is a bounded LRU; when a directory is given,
+        renders are also kept on disk, where all processes share them.
+    """
+    def __init__(self, maxsize=10000, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+        self.disk_hits = 0
+
+    def configure(self, maxsize, directory=None):
+        if maxsize != self.memory.maxsize:
+            self.memory = LRUCache(maxsize)
+        self.directory = directory
+
+    def key(self, body, tags):
+        digest = hashlib.sha1(('%d\0%s\0' % (
+            RENDERER_VERSION, ','.join(tags))).encode('utf-8'))
+        digest.update(body.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.html')
+
+    def _read(self, key):
+        try:
+            with io.open(self._path(key), encoding='utf-8') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _write(self, key, html):
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write to a temporary file first so readers never see a
+            # partially written render
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                f.write(html)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def render(self, body, tags):
+        key = self.key(body, tags)
+        html = self.memory.get(key)
+        if html is not None:
+            return html
+        if self.directory is not None:
+            html = self._read(key)
+            if html is not None:
+                self.disk_hits += 1
+        if html is None:
+            html = _render(body, tags)
+            if self.directory is not None:
+                self._write(key, html)
+        self.memory.set(key, html)
+        return html
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+render_cache = RenderCache()
+
+def init_app(app):
+    render_cache.configure(app.config['FLASKY_RENDER_CACHE_SIZE'],
+                           app.config['FLASKY_RENDER_CACHE_DIR'])
+    render_queue.init_app(app)
+
+def _render(body, tags):
+    return bleach.linkify(bleach.clean(
+        markdown(body, output_format='html'),
+        tags=tags, strip=True))
+
+def render(body, tags):
+    """ markdown to sanitized and linkified HTML """
+    if body is None:
+        return None
+    return render_cache.render(body, tags)
+
+# module level functions, so they can be sent to a process pool
+
+def render_post(body):
+    return render(body, POST_TAGS)
+
+def render_comment(body):
+    return render(body, COMMENT_TAGS)
+
+RENDERERS = {
+    'posts': render_post,
+    'comments': render_comment,
+}
+
+class RenderQueue(object):
+    """ renders bodies on a pool of worker threads, off the request thread.
+
+        Each job re-renders one committed row and stores the result with an
+        UPDATE that only matches while the row still has the body that was
+        rendered, so a slow job never overwrites a newer edit.
+
+        Jobs only live in memory and are lost when their process exits, so
+        every FLASKY_RENDER_SWEEP_INTERVAL seconds, starting with the first
+        request, the rows still without body_html after that long are
+        queued again.
+    """
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.sweep_interval = 0
+        self.queue = Queue()
+        self.threads = []
+        self.sweeper = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['FLASKY_RENDER_WORKERS']
+        self.sweep_interval = app.config['FLASKY_RENDER_SWEEP_INTERVAL']
+        if app.config['FLASKY_ASYNC_RENDERING']:
+            app.before_first_request(self.start)
+
+    def start(self):
+        with self._lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            if self.sweeper is None and self.sweep_interval:
+                self.sweeper = threading.Thread(
+                    target=self._sweep_periodically)
+                self.sweeper.daemon = True
+                self.sweeper.start()
+
+    def submit(self, table, id, body):
+        self.start()
+        self.queue.put((table, id, body))
+
+    def sweep(self, older_than=None):
+        """ queue the rows still waiting for their body_html, changed more
+            than older_than seconds ago when given.  Returns their number.
+        """
+        queued = 0
+        engine = db.get_engine(self.app)
+        for name in RENDERERS:
+            t = db.metadata.tables[name]
+            query = db.select([t.c.id, t.c.body]).where(db.and_(
+                t.c.body_html == None, t.c.body != None))
+            if older_than is not None:
+                since = datetime.utcnow() - timedelta(seconds=older_than)
+                query = query.where(db.or_(t.c.updated_at == None,
+                                           t.c.updated_at < since))
+            for id, body in engine.execute(query).fetchall():
+                self.submit(name, id, body)
+                queued += 1
+        return queued
+
+    def _sweep_periodically(self):
+        while True:
+            try:
+                self.sweep(older_than=self.sweep_interval)
+            except Exception:
+                self.app.logger.exception('Sweeping unrendered rows failed')
+            time.sleep(self.sweep_interval)
+
+    def join(self):
+        """ wait until every submitted job is done """
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            table, id, body = self.queue.get()
+            try:
+                with self.app.app_context():
+                    t = db.metadata.tables[table]
+                    result = db.engine.execute(t.update().where(db.and_(
+                        t.c.id == id, t.c.body == body)).values(
+                        body_html=RENDERERS[table](body),
+                        version=t.c.version + 1,
+                        updated_at=datetime.utcnow()))
+                    if result.rowcount:
+                        page_cache.invalidate('%s:%d' % (table, id))
+            except Exception:
+                self.app.logger.exception('Rendering %s #%d failed' %
+                                          (table, id))
+            finally:
+                self.queue.task_done()
+
+render_queue = RenderQueue()
+
+def defer(target):
+    """ leave body_html empty, the row is rendered once it is committed """
+    target.body_html = None
+    target._render_pending = True
+
+def schedule(target):
+    """ called after a row is flushed, hands deferred rendering to the
+        worker pool when the transaction commits
+    """
+    if target.__dict__.pop('_render_pending', False):
+        after_commit(object_session(target),
+                     partial(render_queue.submit, target.__tablename__,
+                             target.id, target.body))
+
+def _echo(message):
+    print(message)
+
+def rerender(model, processes=None, chunk_size=1000, checkpoint=None,
+             output=_echo):
+    """ re-render body_html of every row of a Post or Comment model.
+
+        Rows are read in chunks of chunk_size ordered by id, rendered on a
+        pool of worker processes, or in this process when processes is 1,
+        and written back with one executemany
+        UPDATE per chunk.  Each chunk is committed on its own and, when a
+        checkpoint file is given, the last id written is saved to it so that
+        an interrupted run resumes where it stopped.
+    """
+    table = model.__table__
+    render_body = RENDERERS[table.name]
+    last_id = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            last_id = int(f.read().strip() or 0)
+        output('Resuming %s after id %d' % (table.name, last_id))
+    total = db.session.query(db.func.count(model.id)).filter(
+        model.id > last_id).scalar()
+    update = table.update().where(table.c.id == db.bindparam('row_id')) \
+        .values(body_html=db.bindparam('row_html'),
+                version=table.c.version + 1,
+                updated_at=db.bindparam('row_updated_at'))
+
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+    workers = processes or multiprocessing.cpu_count()
+    done = 0
+    start = time.time()
+    try:
+        while True:
+            rows = db.session.query(model.id, model.body).filter(
+                model.id > last_id).order_by(model.id).limit(chunk_size).all()
+            if not rows:
+                break
+            bodies = [row.body for row in rows]
+            if pool is None:
+                html = [render_body(body) for body in bodies]
+            else:
+                html = pool.map(render_body, bodies,
+                                max(1, len(rows) // (workers * 4)))
+            now = datetime.utcnow()
+            db.session.execute(update, [{'row_id': row.id, 'row_html': h,
+                                         'row_updated_at': now}
+                                        for row, h in zip(rows, html)])
+            db.session.commit()
+            last_id = rows[-1].id
+            if checkpoint is not None:
+                with open(checkpoint, 'w') as f:
+                    f.write('%d\n' % last_id)
+            done += len(rows)
+            elapsed = time.time() - start
+            output('%s: %d/%d rendered, %.0f rows/s' %
+                   (table.name, done, total, done / max(elapsed, 1e-6)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return done
@@ -0,0 +1,84 @@
+import random
+import time
+from flask import Blueprint, current_app, request, session
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event
+from sqlalchemy.sql.expression import SelectBase
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+# blueprints whose GET requests are all read-only
+_read_only_blueprints = set()
+
+def read_only(view_or_blueprint):
+    """ mark a view function, or every view of a blueprint, as safe to serve
+        from a read replica when requested with GET or HEAD
+    """
+    if isinstance(view_or_blueprint, Blueprint):
+        _read_only_blueprints.add(view_or_blueprint.name)
+    else:
+        view_or_blueprint.read_only = True
+    return view_or_blueprint
+
+class RoutingSession(SignallingSession):
+    """ a session sending the SELECTs of read-only requests to a replica.
+
+        The request hook stores the replica's bind key in the session info.
+        As soon as the session writes, by flushing or by executing anything
+        but a SELECT, the key is dropped, so the rest of the request, and
+        the reads after its own writes, go to the primary.
+    """
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.db = db
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None:
+            if isinstance(clause, SelectBase):
+                return self.db.get_engine(self.app, bind=replica)
+            if clause is not None:
+                _wrote(self)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+def _wrote(session, *args):
+    session.info.pop('replica', None)
+    session.info['wrote'] = True
+
+event.listen(RoutingSession, 'after_flush', _wrote)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+def _is_read_only():
+    if request.method not in SAFE_METHODS:
+        return False
+    if request.blueprint in _read_only_blueprints:
+        return True
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'read_only', False)
+
+def init_app(app, db):
+    @app.before_request
+    def route_to_replica():
+        info = db.session().info
+        info.pop('wrote', None)
+        info.pop('replica', None)
+        replicas = current_app.config['FLASKY_REPLICA_BINDS']
+        if replicas and _is_read_only() and \
+                session.get('primary_until', 0) <= time.time():
+            info['replica'] = random.choice(replicas)
+
+    @app.after_request
+    def stick_to_primary(response):
+        # after a write the user reads from the primary until the replicas
+        # have caught up with it
+        s = db.session()
+        if request.method not in SAFE_METHODS or s.info.get('wrote') or \
+                s.new or s.dirty or s.deleted:
+            lag = current_app.config['FLASKY_REPLICA_MAX_LAG']
+            if current_app.config['FLASKY_REPLICA_BINDS'] and lag:
+                session['primary_until'] = time.time() + lag
+        s.info.pop('replica', None)
+        return response
@@ -0,0 +1,195 @@
+import bisect
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from . import db
+from .models import Role, User, Post, Comment, Follow, Timeline
+from .follow_index import follow_index
+from .rendering import render_post, render_comment
+
+SEED_PASSWORD = 'password'
+
+def _echo(message):
+    print(message)
+
+def _power_law(rnd, count, alpha):
+    """ returns a function drawing indexes in [0, count) with Pareto
+        distributed weights, so a few indexes are drawn very often
+    """
+    cumulative = []
+    total = 0.0
+    for i in range(count):
+        total += rnd.paretovariate(alpha)
+        cumulative.append(total)
+
+    def draw():
+        return min(bisect.bisect_left(cumulative, rnd.random() * total),
+                   count - 1)
+    return draw
+
+class _BatchInserter(object):
+    """ collects rows and inserts them with one executemany per batch """
+    def __init__(self, connection, table, batch_size):
+        self.connection = connection
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.connection.execute(self.table.insert(), self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+def _recount(connection, first_user_id, first_post_id):
+    """ set the denormalized counters of the seeded rows in bulk """
+    users = User.__table__
+    posts = Post.__table__
+    comments = Comment.__table__
+    follows = Follow.__table__
+    connection.execute(users.update().where(users.c.id >= first_user_id).values(
+        post_count=db.select([db.func.count(posts.c.id)]).where(
+            posts.c.author_id == users.c.id).as_scalar(),
+        followers_count=db.select([db.func.count()]).select_from(follows).where(
+            follows.c.followed_id == users.c.id).as_scalar(),
+        followed_count=db.select([db.func.count()]).select_from(follows).where(
+            follows.c.follower_id == users.c.id).as_scalar()))
+    connection.execute(posts.update().where(posts.c.id >= first_post_id).values(
+        comment_count=db.select([db.func.count(comments.c.id)]).where(
+            comments.c.post_id == posts.c.id).as_scalar()))
+
+def _advance_sequences(connection):
+    """ the ids were given explicitly, so move the id sequences past them
+        for the rows inserted later on
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in (User.__table__, Post.__table__, Comment.__table__):
+        connection.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "COALESCE(MAX(id), 0) + 1, false) FROM %s" % (table.name,
+                                                           table.name)))
+
+def seed(users=1000, posts=10000, comments=20000, follows=20, seed=None,
+         batch_size=10000, timelines=True, output=_echo):
+    """ bulk insert a realistic, reproducible dataset for load testing.
+
+        Rows are inserted with executemany in batches of batch_size.  The
+        number of users each user follows, the popularity of users and the
+        activity of authors all follow power laws, so a few users have most
+        of the followers, posts and comments.  Bodies and their rendered
+        HTML are drawn from a pre-rendered pool and all seeded users share
+        the password SEED_PASSWORD.
+    """
+    import forgery_py
+
+    rnd = random.Random(seed)
+    random.seed(seed)   # forgery_py draws from the global generator
+    Role.insert_roles()
+    role_id = Role.query.filter_by(default=True).first().id
+    first_user_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    first_post_id = (db.session.query(db.func.max(Post.id)).scalar() or 0) + 1
+    first_comment_id = \
+        (db.session.query(db.func.max(Comment.id)).scalar() or 0) + 1
+    db.session.commit()
+
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    names = [forgery_py.name.full_name() for i in range(1000)]
+    cities = [forgery_py.address.city() for i in range(1000)]
+    post_bodies = []
+    comment_bodies = []
+    for i in range(500):
+        body = forgery_py.lorem_ipsum.sentences(rnd.randint(1, 5))
+        post_bodies.append((body, render_post(body)))
+        body = forgery_py.lorem_ipsum.sentences(rnd.randint(1, 2))
+        comment_bodies.append((body, render_comment(body)))
+
+    now = datetime.utcnow()
+
+    def past(days):
+        return now - timedelta(seconds=rnd.randint(0, days * 24 * 3600))
+
+    popularity = _power_law(rnd, users, 1.2)
+    activity = _power_law(rnd, users, 1.5)
+    start = time.time()
+    with db.engine.begin() as connection:
+        inserter = _BatchInserter(connection, User.__table__, batch_size)
+        for i in range(users):
+            id = first_user_id + i
+            email = 'user%d@example.com' % id
+            member_since = past(730)
+            inserter.add({
+                'id': id, 'email': email, 'username': 'user%d' % id,
+                'role_id': role_id, 'password_hash': password_hash,
+                'confirmed': True, 'name': rnd.choice(names),
+                'location': rnd.choice(cities), 'about_me': '',
+                'member_since': member_since,
+                'last_seen': member_since + timedelta(
+                    seconds=rnd.randint(0, int((now - member_since)
+                                               .total_seconds()))),
+                'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+                'post_count': 0, 'followers_count': 0, 'followed_count': 0,
+                'token_generation': 0})
+        inserter.flush()
+        output('%d users' % inserter.count)
+
+        # everybody follows themselves, plus a power law number of others
+        # picked by popularity
+        inserter = _BatchInserter(connection, Follow.__table__, batch_size)
+        alpha = 1.8
+        for i in range(users):
+            id = first_user_id + i
+            degree = min(users - 1, int(rnd.paretovariate(alpha) * follows *
+                                        (alpha - 1) / alpha))
+            followed = set([i])
+            for attempt in range(degree * 3):
+                if len(followed) > degree:
+                    break
+                followed.add(popularity())
+            for j in followed:
+                inserter.add({'follower_id': id,
+                              'followed_id': first_user_id + j,
+                              'timestamp': past(365)})
+        inserter.flush()
+        output('%d follows' % inserter.count)
+
+        inserter = _BatchInserter(connection, Post.__table__, batch_size)
+        for i in range(posts):
+            body, body_html = rnd.choice(post_bodies)
+            inserter.add({'id': first_post_id + i, 'body': body,
+                          'body_html': body_html, 'timestamp': past(365),
+                          'author_id': first_user_id + activity(),
+                          'comment_count': 0})
+        inserter.flush()
+        output('%d posts' % inserter.count)
+
+        if posts:
+            inserter = _BatchInserter(connection, Comment.__table__,
+                                      batch_size)
+            for i in range(comments):
+                body, body_html = rnd.choice(comment_bodies)
+                inserter.add({'id': first_comment_id + i, 'body': body,
+                              'body_html': body_html, 'timestamp': past(365),
+                              'disabled': False,
+                              'author_id': first_user_id + activity(),
+                              'post_id': first_post_id + rnd.randint(0, posts - 1)})
+            inserter.flush()
+            output('%d comments' % inserter.count)
+
+        _recount(connection, first_user_id, first_post_id)
+        _advance_sequences(connection)
+    # the follows were inserted behind the back of the Follow events
+    follow_index.invalidate()
+    output('Inserted in %.1fs' % (time.time() - start))
+    if timelines:
+        start = time.time()
+        Timeline.rebuild()
+        output('Timelines rebuilt in %.1fs' % (time.time() - start))
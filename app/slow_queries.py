@@ -0,0 +1,148 @@
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+from . import db
+from .benchmarks import percentile
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+|\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+def normalize(statement):
+    """ the shape of a statement: literals, placeholders and IN lists of any
+        length reduced to ?, whitespace collapsed
+    """
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+class SlowQueryLog(object):
+    """ aggregates slow queries by statement shape and captures their plans.
+
+        Slow queries are handed to a worker thread, off the request thread.
+        The first time a shape is seen its plan is captured with EXPLAIN
+        QUERY PLAN on SQLite or EXPLAIN elsewhere.  Every
+        FLASKY_SLOW_QUERY_REPORT_INTERVAL seconds, and at exit, the count
+        and p50/p99 of every shape seen since the previous report are
+        appended to the FLASKY_SLOW_QUERY_LOG JSON lines file, one line per
+        shape, which is rotated at FLASKY_SLOW_QUERY_LOG_BYTES.
+    """
+    def __init__(self):
+        self.app = None
+        self.interval = 60
+        self.handler = None
+        self.queue = Queue()
+        self.thread = None
+        self.plans = {}
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['FLASKY_SLOW_QUERY_REPORT_INTERVAL']
+        path = app.config['FLASKY_SLOW_QUERY_LOG']
+        if path:
+            path = os.path.abspath(path)
+        if self.handler is not None and self.handler.baseFilename != path:
+            self.handler.close()
+            self.handler = None
+        if path and self.handler is None:
+            self.handler = RotatingFileHandler(
+                path, maxBytes=app.config['FLASKY_SLOW_QUERY_LOG_BYTES'],
+                backupCount=5, delay=True)
+
+    def record(self, statement, parameters, duration):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.report)
+        self.queue.put((statement, parameters, duration))
+
+    def join(self):
+        """ wait until every recorded query is aggregated """
+        self.queue.join()
+
+    def explain(self, statement, parameters):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            return None
+        try:
+            with self.app.app_context():
+                if db.engine.dialect.name == 'sqlite':
+                    explain = 'EXPLAIN QUERY PLAN '
+                else:
+                    explain = 'EXPLAIN '
+                rows = db.engine.execute(explain + statement,
+                                         parameters).fetchall()
+            return [' '.join(str(column) for column in row) for row in rows]
+        except Exception as e:
+            return ['EXPLAIN failed: %s' % e]
+
+    def add(self, statement, parameters, duration):
+        shape = normalize(statement)
+        if shape not in self.plans:
+            self.plans[shape] = self.explain(statement, parameters)
+        with self._lock:
+            self.samples.setdefault(shape, []).append(duration * 1000)
+
+    def report(self):
+        """ write and reset the aggregates, returns the number of shapes """
+        with self._lock:
+            samples, self.samples = self.samples, {}
+        if not samples or self.handler is None:
+            return 0
+        now = datetime.utcnow().isoformat()
+        for shape, durations in sorted(samples.items()):
+            line = json.dumps({
+                'time': now,
+                'statement': shape,
+                'count': len(durations),
+                'p50_ms': percentile(durations, 50),
+                'p99_ms': percentile(durations, 99),
+                'max_ms': max(durations),
+                'plan': self.plans.get(shape),
+            }, sort_keys=True)
+            self.handler.emit(logging.makeLogRecord({'msg': line}))
+        self.handler.flush()
+        return len(samples)
+
+    def _work(self):
+        next_report = time.time() + self.interval
+        while True:
+            try:
+                statement, parameters, duration = self.queue.get(
+                    timeout=max(0, next_report - time.time()))
+            except Empty:
+                statement = None
+            if statement is not None:
+                try:
+                    self.add(statement, parameters, duration)
+                except Exception:
+                    self.app.logger.exception('Recording a slow query failed')
+                finally:
+                    self.queue.task_done()
+            if time.time() >= next_report:
+                next_report = time.time() + self.interval
+                try:
+                    self.report()
+                except Exception:
+                    self.app.logger.exception('Writing slow queries failed')
+
+slow_query_log = SlowQueryLog()
+
+def init_app(app):
+    slow_query_log.init_app(app)
@@ -20,8 +20,69 @@ class Config(object):
     FLASKY_POSTS_PER_PAGE = 15
     FLASKY_FOLLOWERS_PER_PAGE = 25
     FLASKY_COMMENTS_PER_PAGE = 15
+    # posts by authors with more followers are pulled at read time
+    # instead of being pushed to every follower's timeline; run
+    # manage.py rebuild_timelines after changing it
+    FLASKY_TIMELINE_FANOUT_LIMIT = 5000
+    # rendered markdown kept in memory, and optionally on disk
+    FLASKY_RENDER_CACHE_SIZE = 10000
+    FLASKY_RENDER_CACHE_DIR = os.environ.get('FLASKY_RENDER_CACHE_DIR')
+    # render new and edited bodies on worker threads after the commit
+    FLASKY_ASYNC_RENDERING = bool(os.environ.get('FLASKY_ASYNC_RENDERING'))
+    FLASKY_RENDER_WORKERS = 2
+    # seconds between the sweeps queueing the rows whose rendering was lost
+    # with an exited worker process, 0 to disable them
+    FLASKY_RENDER_SWEEP_INTERVAL = 60
+    # seconds before other processes' role changes are picked up
+    FLASKY_ROLE_CACHE_TTL = 60
+    # seconds a logged in user is resolved from memory between lookups
+    FLASKY_USER_CACHE_TTL = 30
+    # seconds a verified API password or token is trusted without checking
+    FLASKY_CREDENTIAL_CACHE_TTL = 300
+    # last_seen updates are written in batches of this many users, or
+    # after at most this many seconds
+    FLASKY_LAST_SEEN_BATCH = 500
+    FLASKY_LAST_SEEN_DELAY = 60
+    # seconds before the follow graph index is rebuilt to pick up the
+    # follows written by other processes
+    FLASKY_FOLLOW_INDEX_TTL = 300
+    # read replicas, space separated in REPLICA_DATABASE_URLS, serve the
+    # read-only GET requests; after a write a user stays on the primary for
+    # FLASKY_REPLICA_MAX_LAG seconds, the most the replicas may lag behind
+    SQLALCHEMY_BINDS = dict(
+        ('replica%d' % i, url) for i, url in
+        enumerate(os.environ.get('REPLICA_DATABASE_URLS', '').split()))
+    FLASKY_REPLICA_BINDS = sorted(SQLALCHEMY_BINDS)
+    FLASKY_REPLICA_MAX_LAG = 5
     SQLALCHEMY_RECORD_QUERIES = True
+    # queries a request may issue, per endpoint with a default, and how many
+    # runs of one statement with different parameters flag an N+1 pattern;
+    # violations are logged, or raised when FLASKY_QUERY_BUDGET_RAISE is set
+    FLASKY_QUERY_BUDGET = 40
+    FLASKY_QUERY_BUDGETS = {}
+    FLASKY_N_PLUS_ONE_THRESHOLD = 5
+    FLASKY_QUERY_BUDGET_RAISE = False
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    # slow queries are aggregated by statement shape, with their plans, and
+    # reported to this JSON lines file when one is given
+    FLASKY_SLOW_QUERY_LOG = os.environ.get('FLASKY_SLOW_QUERY_LOG')
+    FLASKY_SLOW_QUERY_LOG_BYTES = 1024 * 1024
+    FLASKY_SLOW_QUERY_REPORT_INTERVAL = 60
+    # /metrics wants this bearer token, or an administrator when unset;
+    # worker processes share their metrics through files in the directory
+    FLASKY_METRICS_TOKEN = os.environ.get('FLASKY_METRICS_TOKEN')
+    FLASKY_METRICS_DIR = os.environ.get('FLASKY_METRICS_DIR')
+    FLASKY_METRICS_SYNC_INTERVAL = 5
+    # pages served to anonymous visitors are cached for this many seconds,
+    # then served stale for as long while one request regenerates them;
+    # writes made through other worker processes only show up on expiry
+    FLASKY_PAGE_CACHE_TTL = 30
+    FLASKY_PAGE_CACHE_STALE = 30
+    FLASKY_PAGE_CACHE_WAIT = 5
+    # rendered posts and comments kept per process, keyed by row version
+    FLASKY_FRAGMENT_CACHE_SIZE = 10000
+    # encoded API representations kept per process, keyed by row version
+    FLASKY_JSON_CACHE_SIZE = 10000
     SSL_DISABLE = True
 
     @staticmethod
@@ -38,6 +99,10 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data.sqlite')
     WTF_CSRF_ENABLED = False
+    FLASKY_QUERY_BUDGET_RAISE = True
+    FLASKY_SLOW_QUERY_LOG = None
+    FLASKY_PAGE_CACHE_TTL = 0
+    FLASKY_RENDER_SWEEP_INTERVAL = 0
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
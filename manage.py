@@ -2,6 +2,7 @@
 import os
 import errno
 import socket
+import time
 
 COV = None
 if os.environ.get('FLASK_COVERAGE'):
@@ -55,20 +56,129 @@ def profile(length=25, profile_dir=None):
         profile_dir=profile_dir)
     app.run()
 
+@manager.command
+def bench_indexes(posts=200000, repeat=200, seed=0):
+    """Compare the hot queries without and with the composite indexes."""
+    from app.benchmarks import benchmark_indexes
+    benchmark_indexes(users=max(posts // 20, 1), posts=posts,
+                      comments=posts * 2, follows=posts, repeat=repeat,
+                      seed=seed)
+
+@manager.option('--users', type=int, default=200)
+@manager.option('--posts', type=int, default=2000)
+@manager.option('--comments', type=int, default=4000)
+@manager.option('--follows', type=int, default=20,
+                help='average number of users each user follows')
+@manager.option('--requests', type=int, default=200,
+                help='measured requests per scenario')
+@manager.option('--warmup', type=int, default=10,
+                help='unmeasured requests per scenario')
+@manager.option('--seed', type=int, default=0)
+@manager.option('--scenario', dest='scenarios', action='append',
+                help='run only this scenario, can be repeated')
+@manager.option('--database', default=None,
+                help='database URL, defaults to a scratch SQLite database')
+@manager.option('--output', default=None,
+                help='JSON results file, defaults to bench-<time>.json')
+@manager.option('--baseline', default=None,
+                help='JSON results of an earlier run to compare with')
+@manager.option('--threshold', type=float, default=0.1,
+                help='relative change reported as a regression')
+def bench(users, posts, comments, follows, requests, warmup, seed, scenarios,
+          database, output, baseline, threshold):
+    """Benchmark the main pages and API endpoints on a seeded dataset."""
+    from app.benchmarks import run_benchmark, diff_results, save_results, \
+        load_results
+    results = run_benchmark(app, users=users, posts=posts, comments=comments,
+                            follows=follows, requests=requests, warmup=warmup,
+                            seed=seed, scenarios=scenarios, database=database)
+    output = output or time.strftime('bench-%Y%m%d-%H%M%S.json')
+    save_results(results, output)
+    print('Results written to %s' % output)
+    if baseline:
+        diff_results(load_results(baseline), results, threshold=threshold)
+
+@manager.command
+def bench_diff(old, new, threshold=0.1):
+    """Compare the results of two benchmark runs."""
+    from app.benchmarks import diff_results, regressions, load_results
+    threshold = float(threshold)
+    changes = diff_results(load_results(old), load_results(new),
+                           threshold=threshold)
+    if regressions(changes, threshold):
+        raise SystemExit(1)
+
+@manager.command
+def check_counters(repair=False):
+    """Check the denormalized counters against the real counts."""
+    drift = User.check_counters(repair=repair) + \
+        Post.check_counters(repair=repair)
+    for id, column, stored, actual in drift:
+        print('%s of #%d is %s, should be %d' % (column, id, stored, actual))
+    if not drift:
+        print('All counters are in sync.')
+    elif repair:
+        print('Repaired %d counters.' % len(drift))
+
+@manager.command
+def rebuild_timelines():
+    """Rebuild the materialized home timelines."""
+    from app.models import Timeline
+    Timeline.rebuild()
+
+@manager.option('--users', type=int, default=1000)
+@manager.option('--posts', type=int, default=10000)
+@manager.option('--comments', type=int, default=20000)
+@manager.option('--follows', type=int, default=20,
+                help='average number of users each user follows')
+@manager.option('--seed', type=int, default=None,
+                help='random seed, for a reproducible dataset')
+@manager.option('--batch-size', dest='batch_size', type=int, default=10000)
+@manager.option('--skip-timelines', dest='timelines', action='store_false')
+def seed(users, posts, comments, follows, seed, batch_size, timelines):
+    """Bulk insert fake users, follows, posts and comments."""
+    from app.seed import seed as seed_database
+    seed_database(users=users, posts=posts, comments=comments,
+                  follows=follows, seed=seed, batch_size=batch_size,
+                  timelines=timelines)
+
+@manager.option('--processes', type=int, default=None,
+                help='worker processes, defaults to the number of CPUs')
+@manager.option('--chunk-size', dest='chunk_size', type=int, default=1000)
+@manager.option('--restart', action='store_true',
+                help='ignore the checkpoint of an interrupted run')
+def rerender(processes, chunk_size, restart):
+    """Re-render body_html of every post and comment."""
+    from app.rendering import rerender as rerender_table
+    for model in (Post, Comment):
+        checkpoint = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '.rerender-' + model.__tablename__)
+        if restart and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        rerender_table(model, processes=processes, chunk_size=chunk_size,
+                       checkpoint=checkpoint)
+
 @manager.command
 def deploy():
     """Run deployment tasks."""
     from flask.ext.migrate import upgrade
     from app.models import Role, User
 
+    def timed(message, task, *args):
+        start = time.time()
+        result = task(*args)
+        print('%s in %.2fs' % (message, time.time() - start))
+        return result
+
     # migrate database to latest revision
-    upgrade()
+    timed('Migrated the database', upgrade)
 
     # create user roles
-    Role.insert_roles()
+    timed('Synchronized roles', Role.insert_roles)
 
     # create self-follows for all users
-    User.add_self_follows()
+    added = timed('Added self-follows', User.add_self_follows)
+    print('%d users did not follow themselves' % added)
 
 @app.teardown_request
 def commit_on_request_success(exception):
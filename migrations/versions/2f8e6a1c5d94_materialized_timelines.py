@@ -0,0 +1,42 @@
+"""materialized timelines
+
+Revision ID: 2f8e6a1c5d94
+Revises: 4b1d2c9e7f30
+Create Date: 2026-10-18 11:03:27.480116
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f8e6a1c5d94'
+down_revision = '4b1d2c9e7f30'
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timelines_user_id_timestamp', 'timelines', ['user_id', 'timestamp'], unique=False)
+
+    # backfill the timelines from the existing follows and posts, leaving
+    # out the authors over the fan-out limit like Timeline.fan_out does
+    limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+    op.execute('INSERT INTO timelines (user_id, post_id, timestamp) '
+               'SELECT follows.follower_id, posts.id, posts.timestamp '
+               'FROM follows JOIN posts '
+               'ON posts.author_id = follows.followed_id '
+               'JOIN users ON users.id = follows.followed_id '
+               'WHERE COALESCE(users.followers_count, 0) <= %d' % limit)
+
+
+def downgrade():
+    op.drop_index('ix_timelines_user_id_timestamp', table_name='timelines')
+    op.drop_table('timelines')
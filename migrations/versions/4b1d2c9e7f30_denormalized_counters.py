@@ -0,0 +1,40 @@
+"""denormalized counters
+
+Revision ID: 4b1d2c9e7f30
+Revises: 57c60219becc
+Create Date: 2026-10-18 09:12:40.215903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1d2c9e7f30'
+down_revision = '57c60219becc'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('followers_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('followed_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+
+    # backfill the counters from the existing rows
+    op.execute('UPDATE users SET '
+               'post_count = (SELECT COUNT(*) FROM posts '
+               'WHERE posts.author_id = users.id), '
+               'followers_count = (SELECT COUNT(*) FROM follows '
+               'WHERE follows.followed_id = users.id), '
+               'followed_count = (SELECT COUNT(*) FROM follows '
+               'WHERE follows.follower_id = users.id)')
+    op.execute('UPDATE posts SET '
+               'comment_count = (SELECT COUNT(*) FROM comments '
+               'WHERE comments.post_id = posts.id)')
+
+
+def downgrade():
+    op.drop_column('posts', 'comment_count')
+    op.drop_column('users', 'followed_count')
+    op.drop_column('users', 'followers_count')
+    op.drop_column('users', 'post_count')
@@ -0,0 +1,28 @@
+"""composite indexes
+
+Revision ID: 5e3a9b7c1f28
+Revises: 2f8e6a1c5d94
+Create Date: 2026-10-18 13:20:51.036742
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e3a9b7c1f28'
+down_revision = '2f8e6a1c5d94'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_posts_author_id_timestamp', 'posts', ['author_id', 'timestamp'], unique=False)
+    op.create_index('ix_comments_post_id_timestamp', 'comments', ['post_id', 'timestamp'], unique=False)
+    op.create_index('ix_follows_followed_id_timestamp', 'follows', ['followed_id', 'timestamp'], unique=False)
+    op.create_index('ix_follows_follower_id_timestamp', 'follows', ['follower_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_follows_follower_id_timestamp', table_name='follows')
+    op.drop_index('ix_follows_followed_id_timestamp', table_name='follows')
+    op.drop_index('ix_comments_post_id_timestamp', table_name='comments')
+    op.drop_index('ix_posts_author_id_timestamp', table_name='posts')
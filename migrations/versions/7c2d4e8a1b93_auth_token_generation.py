@@ -0,0 +1,22 @@
+"""auth token generation
+
+Revision ID: 7c2d4e8a1b93
+Revises: 5e3a9b7c1f28
+Create Date: 2026-10-18 15:02:17.480126
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2d4e8a1b93'
+down_revision = '5e3a9b7c1f28'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column('token_generation', sa.Integer(), nullable=True, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'token_generation')
@@ -0,0 +1,32 @@
+"""row versions
+
+Revision ID: 9d4f1b6c3e27
+Revises: 7c2d4e8a1b93
+Create Date: 2026-10-18 18:40:06.318254
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4f1b6c3e27'
+down_revision = '7c2d4e8a1b93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    for table in ('users', 'posts', 'comments'):
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # the latest known change of the existing rows
+    op.execute('UPDATE users SET updated_at = '
+               'COALESCE(last_seen, member_since)')
+    op.execute('UPDATE posts SET updated_at = timestamp')
+    op.execute('UPDATE comments SET updated_at = timestamp')
+
+
+def downgrade():
+    for table in ('comments', 'posts', 'users'):
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
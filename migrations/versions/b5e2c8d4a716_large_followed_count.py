@@ -0,0 +1,31 @@
+"""large followed count
+
+Revision ID: b5e2c8d4a716
+Revises: 9d4f1b6c3e27
+Create Date: 2026-10-18 21:14:52.603118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5e2c8d4a716'
+down_revision = '9d4f1b6c3e27'
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+def upgrade():
+    op.add_column('users', sa.Column('large_followed_count', sa.Integer(), nullable=True, server_default='0'))
+
+    # count the followed authors over the fan-out limit
+    limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+    op.execute('UPDATE users SET '
+               'large_followed_count = (SELECT COUNT(*) FROM follows '
+               'JOIN users AS followed ON followed.id = follows.followed_id '
+               'WHERE follows.follower_id = users.id '
+               'AND COALESCE(followed.followers_count, 0) > %d)' % limit)
+
+
+def downgrade():
+    op.drop_column('users', 'large_followed_count')
@@ -3,6 +3,7 @@ from app import create_app, db
 from app.models import Role, User, Post, Comment
 from base64 import b64encode
 from flask import url_for
+from werkzeug.security import generate_password_hash
 import json
 
 class APITestCase(unittest.TestCase):
@@ -321,4 +322,273 @@ class APITestCase(unittest.TestCase):
             headers=self.get_api_headers(token, ""))
         self.assertTrue(response.status_code==200)
 
-        
\ No newline at end of file
+
+    def test_cursor_pagination(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        Post.generate_fake(testing=True)
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # walk forward through every page
+        url = url_for('api.get_posts', cursor='', count=1)
+        seen = []
+        pages = []
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertTrue(response.status_code == 200)
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(json_response['count'] == 100)
+            seen += [post['url'] for post in json_response['posts']]
+            pages.append(json_response)
+            url = json_response['next']
+        self.assertTrue(len(seen) == 100)
+        self.assertTrue(len(set(seen)) == 100)
+        self.assertIsNone(pages[0]['prev'])
+
+        # walk one page back
+        response = self.client.get(pages[2]['prev'], headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['posts'] == pages[1]['posts'])
+
+        # the total is optional in cursor mode
+        response = self.client.get(url_for('api.get_posts', cursor=''),
+                                   headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertIsNone(json_response['count'])
+
+        # malformed cursors are rejected
+        response = self.client.get(url_for('api.get_posts', cursor='bogus'),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 400)
+
+    def test_async_rendering(self):
+        from app.rendering import render_queue
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['FLASKY_ASYNC_RENDERING'] = True
+        try:
+            response = self.client.post(
+                url_for('api.new_post'),
+                headers=self.get_api_headers('john@example.com', 'cat'),
+                data=json.dumps({'body': 'body of the *blog* post'}))
+            self.assertTrue(response.status_code == 202)
+            status_url = response.headers.get('Location')
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(json_response['status_url'] == status_url)
+            render_queue.join()
+
+            response = self.client.get(
+                status_url,
+                headers=self.get_api_headers('john@example.com', 'cat'))
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(json_response['status'] == 'ready')
+            response = self.client.get(
+                json_response['url'],
+                headers=self.get_api_headers('john@example.com', 'cat'))
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(json_response['body_html'] ==
+                            '<p>body of the <em>blog</em> post</p>')
+        finally:
+            self.app.config['FLASKY_ASYNC_RENDERING'] = False
+
+    def test_credential_cache(self):
+        from app.api_1_0.authentication import credential_cache
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+
+        # the second call is verified from the cache
+        response = self.client.get(
+            url_for('api.get_token'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertTrue(response.status_code == 200)
+        token = json.loads(response.data.decode('utf-8'))['token']
+        hits = credential_cache.hits
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(credential_cache.hits == hits + 1)
+
+        # changing the password invalidates the cached verification
+        u.password = 'dog'
+        db.session.commit()
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertTrue(response.status_code == 401)
+
+        # and so does a change made by another process, which the cached
+        # user snapshot does not know about
+        for i in range(2):
+            db.session.remove()
+            response = self.client.get(
+                url_for('api.get_posts'),
+                headers=self.get_api_headers('john@example.com', 'dog'))
+            self.assertTrue(response.status_code == 200)
+        db.engine.execute(User.__table__.update().where(
+            User.__table__.c.id == u.id).values(
+            password_hash=generate_password_hash('cow')))
+        db.session.remove()
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertTrue(response.status_code == 401)
+        u = User.query.get(u.id)
+        u.password = 'dog'
+        db.session.commit()
+
+        # revoking tokens invalidates cached token verifications
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 200)
+        response = self.client.delete(
+            url_for('api.revoke_tokens'),
+            headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertTrue(response.status_code == 200)
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 401)
+
+        # also when revoked by another process
+        response = self.client.get(
+            url_for('api.get_token'),
+            headers=self.get_api_headers('john@example.com', 'dog'))
+        token = json.loads(response.data.decode('utf-8'))['token']
+        for i in range(2):
+            db.session.remove()
+            response = self.client.get(
+                url_for('api.get_posts'),
+                headers=self.get_api_headers(token, ''))
+            self.assertTrue(response.status_code == 200)
+        db.engine.execute(User.__table__.update().where(
+            User.__table__.c.id == u.id).values(
+            token_generation=User.__table__.c.token_generation + 1))
+        db.session.remove()
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 401)
+
+    def test_conditional_get(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        post = Post(body='body of the post', author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # an unchanged post is not sent again
+        url = url_for('api.get_post', id=post.id)
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag)
+        self.assertTrue(response.headers.get('Last-Modified'))
+        headers['If-None-Match'] = etag
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 304)
+        self.assertTrue(response.data == b'')
+
+        # a new version of it is
+        post.body = 'updated body'
+        db.session.commit()
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.headers.get('ETag') != etag)
+
+        # and so are the listings showing it, once it changes again
+        del headers['If-None-Match']
+        url = url_for('api.get_posts')
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        headers['If-None-Match'] = response.headers.get('ETag')
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 304)
+        db.session.add(Comment(body='a comment', author=u, post=post))
+        db.session.commit()
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['posts'][0]['comment_count'] == 1)
+
+    def test_json_cache(self):
+        from app.json_cache import json_cache
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        posts = [Post(body='post #%d' % i, author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        self.assertTrue(json_cache.cache.maxsize ==
+                        self.app.config['FLASKY_JSON_CACHE_SIZE'])
+
+        # the second listing is spliced from the cached posts
+        response = self.client.get(url_for('api.get_posts'), headers=headers)
+        self.assertTrue(response.status_code == 200)
+        first = json.loads(response.data.decode('utf-8'))
+        hits = json_cache.cache.hits
+        response = self.client.get(url_for('api.get_posts'), headers=headers)
+        self.assertTrue(json.loads(response.data.decode('utf-8')) == first)
+        self.assertTrue(json_cache.cache.hits == hits + 3)
+        self.assertTrue(sorted(p['body'] for p in first['posts']) ==
+                        ['post #0', 'post #1', 'post #2'])
+
+        # a changed post is encoded again
+        posts[0].body = 'edited'
+        db.session.commit()
+        response = self.client.get(url_for('api.get_posts'), headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue('edited' in [p['body'] for p in json_response['posts']])
+        self.assertTrue(json_cache.cache.hits == hits + 5)
+
+    def test_sparse_fieldsets(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        posts = [Post(body='post #%d' % i, author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # only the requested fields are returned
+        response = self.client.get(url_for('api.get_post', id=posts[0].id,
+                                           fields='id,timestamp'),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(sorted(json_response.keys()) == ['id', 'timestamp'])
+        self.assertTrue(json_response['id'] == posts[0].id)
+        sparse_etag = response.headers['ETag']
+        response = self.client.get(url_for('api.get_post', id=posts[0].id),
+                                   headers=headers)
+        self.assertTrue('body' in json.loads(response.data.decode('utf-8')))
+        self.assertTrue(response.headers['ETag'] != sparse_etag)
+
+        # the links to the other pages keep the fieldset
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 2
+        response = self.client.get(url_for('api.get_posts', fields='body'),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(all(list(p.keys()) == ['body']
+                            for p in json_response['posts']))
+        self.assertTrue('fields=body' in json_response['next'])
+
+        # unknown fields are rejected
+        response = self.client.get(url_for('api.get_user', id=u.id,
+                                           fields='username,password_hash'),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 400)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app.benchmarks import diff_results, regressions, save_results, \
+    load_results
+
+def run(rps, p50, p95, p99):
+    return {'requests': 100, 'errors': 0, 'seconds': 1.0, 'rps': rps,
+            'mean_ms': p50, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+class BenchmarksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old = {'scenarios': {
+            'index': run(100.0, 10.0, 20.0, 40.0),
+            'post page': run(50.0, 20.0, 40.0, 80.0),
+            'gone': run(10.0, 1.0, 1.0, 1.0)}}
+        self.new = {'scenarios': {
+            # 5% slower at p50 is within the threshold
+            'index': run(100.0, 10.5, 20.0, 40.0),
+            # fewer requests per second and a slower tail are not
+            'post page': run(40.0, 20.0, 40.0, 100.0),
+            'added': run(10.0, 1.0, 1.0, 1.0)}}
+
+    def test_diff(self):
+        lines = []
+        changes = diff_results(self.old, self.new, threshold=0.1,
+                               output=lines.append)
+        self.assertTrue(sorted(changes) == ['index', 'post page'])
+        self.assertTrue(abs(changes['index']['p50_ms'] - 0.05) < 1e-9)
+        self.assertTrue(abs(changes['post page']['rps'] + 0.2) < 1e-9)
+        self.assertTrue(any('gone' in l and 'old' in l for l in lines))
+        self.assertTrue(any('added' in l and 'new' in l for l in lines))
+        self.assertTrue([l for l in lines if l.startswith('Regression')] ==
+                        ['Regression: post page rps -20.0%',
+                         'Regression: post page p99_ms +25.0%'])
+
+    def test_threshold(self):
+        changes = diff_results(self.old, self.new, output=lambda m: None)
+        self.assertTrue([r[:2] for r in regressions(changes, 0.1)] ==
+                        [('post page', 'rps'), ('post page', 'p99_ms')])
+        self.assertTrue([r[:2] for r in regressions(changes, 0.01)] ==
+                        [('index', 'p50_ms'), ('post page', 'rps'),
+                         ('post page', 'p99_ms')])
+        lines = []
+        diff_results(self.old, self.new, threshold=0.3, output=lines.append)
+        self.assertTrue(lines[-1] == 'No regression over 30%')
+
+    def test_results_round_trip(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bench.json')
+            save_results(self.old, path)
+            self.assertTrue(load_results(path) == self.old)
+        finally:
+            shutil.rmtree(directory)
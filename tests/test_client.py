@@ -1,7 +1,8 @@
 import unittest
 from app import create_app, db
-from app.models import User, Role
-from flask import url_for
+from app.models import User, Role, Post, Comment, with_authors
+from flask import url_for, request
+from flask.ext.sqlalchemy import get_debug_queries
 import re
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -52,3 +53,218 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.client.get(url_for('auth.logout'), follow_redirects=True)
         data = response.get_data(as_text=True)
         self.assertTrue('You have been logged out' in data)
+
+    def add_posts(self, first, count):
+        for i in range(first, first + count):
+            u = User(email='user%d@example.com' % i, username='user%d' % i,
+                     password='cat', confirmed=True)
+            post = Post(body='post #%d' % i, author=u)
+            db.session.add_all([u, post])
+        db.session.commit()
+        return post.id
+
+    def add_comments(self, post_id):
+        for u in User.query.all():
+            db.session.add(Comment(body='comment', author=u, post_id=post_id))
+        db.session.commit()
+
+    def count_queries(self, url):
+        db.session.remove()
+        before = len(get_debug_queries())
+        response = self.client.get(url)
+        self.assertTrue(response.status_code == 200)
+        return len(get_debug_queries()) - before
+
+    def test_listing_query_count(self):
+        # the number of queries per page must not grow with the number of
+        # distinct authors shown on it, everything fits on the first page
+        self.app.config['FLASKY_COMMENTS_PER_PAGE'] = 50
+        self.add_posts(0, 2)
+        few = self.count_queries(url_for('main.index'))
+        post_id = self.add_posts(2, 10)
+        self.assertTrue(self.count_queries(url_for('main.index')) == few)
+
+        self.add_comments(post_id)
+        few = self.count_queries(url_for('main.post', id=post_id))
+        self.add_posts(12, 5)
+        self.add_comments(post_id)
+        self.assertTrue(
+            self.count_queries(url_for('main.post', id=post_id)) == few)
+
+    def test_query_budget(self):
+        from app.exceptions import QueryBudgetExceeded
+        from app.query_budget import query_stats
+        self.add_posts(0, 6)
+
+        @self.app.route('/authors')
+        def authors():
+            query = Post.query
+            if request.args.get('eager'):
+                query = with_authors(query)
+            return ' '.join(p.author.username for p in query)
+
+        # one lazy load of the author per post is flagged
+        db.session.remove()
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/authors')
+        self.assertTrue(self.count_queries('/authors?eager=1') == 1)
+        self.assertTrue(query_stats.endpoints['authors']['requests'] == 2)
+
+        # and so are requests over their budget
+        self.app.config['FLASKY_QUERY_BUDGETS'] = {'authors': 0}
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/authors?eager=1')
+
+    def test_slow_query_log(self):
+        import json
+        import os
+        import tempfile
+        from app.slow_queries import slow_query_log, normalize
+        self.assertTrue(
+            normalize("SELECT * FROM posts WHERE id IN (1, 2,\n 3) "
+                      "AND body = 'it''s'") ==
+            'SELECT * FROM posts WHERE id IN (?) AND body = ?')
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.app.config['FLASKY_SLOW_DB_QUERY_TIME'] = 0
+        self.app.config['FLASKY_SLOW_QUERY_LOG'] = path
+        slow_query_log.init_app(self.app)
+        try:
+            self.add_posts(0, 2)
+            slow_query_log.report()
+            for i in range(2):
+                self.client.get(url_for('main.index'))
+            slow_query_log.join()
+            self.assertTrue(slow_query_log.report() > 0)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            posts = [line for line in lines
+                     if line['statement'].startswith('SELECT posts.id')]
+            self.assertTrue(posts[0]['count'] >= 2)
+            self.assertTrue(posts[0]['p99_ms'] >= posts[0]['p50_ms'])
+            self.assertTrue(posts[0]['plan'])
+        finally:
+            self.app.config['FLASKY_SLOW_QUERY_LOG'] = None
+            slow_query_log.init_app(self.app)
+            os.remove(path)
+
+    def test_metrics(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from app.metrics import metrics
+        metrics.clear()
+        self.assertTrue(self.client.get('/metrics').status_code == 403)
+        self.app.config['FLASKY_METRICS_TOKEN'] = 'secret'
+        headers = {'Authorization': 'Bearer secret'}
+        self.client.get(url_for('main.index'))
+        self.client.get(url_for('main.index'))
+
+        response = self.client.get('/metrics', headers=headers)
+        self.assertTrue(response.status_code == 200)
+        data = response.get_data(as_text=True)
+        self.assertTrue('flasky_requests_total{endpoint="main.index",'
+                        'method="GET",status="200"} 2' in data)
+        for kind in ('total', 'db', 'template'):
+            self.assertTrue('flasky_request_duration_seconds_count{'
+                            'endpoint="main.index",kind="%s"} 2' % kind
+                            in data)
+        self.assertTrue('flasky_mail_queue_depth 0' in data)
+
+        # the files of other workers are added up
+        directory = tempfile.mkdtemp()
+        metrics.directory = directory
+        try:
+            with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+                json.dump({'pid': 1, 'gauges': {'flasky_mail_queue_depth': 3},
+                           'requests': {'main.index|GET|200': 5},
+                           'histograms': {}}, f)
+            data = self.client.get('/metrics', headers=headers).get_data(
+                as_text=True)
+            self.assertTrue('flasky_requests_total{endpoint="main.index",'
+                            'method="GET",status="200"} 7' in data)
+        finally:
+            metrics.directory = None
+            shutil.rmtree(directory)
+
+    def test_page_cache(self):
+        from app.page_cache import page_cache
+        self.app.config['FLASKY_PAGE_CACHE_TTL'] = 30
+        page_cache.init_app(self.app)
+        try:
+            post_id = self.add_posts(0, 2)
+            response = self.client.get(url_for('main.index'))
+            self.assertTrue(response.headers['X-Page-Cache'] == 'miss')
+            self.assertTrue(self.count_queries(url_for('main.index')) == 0)
+
+            # editing a post shown on the page invalidates it
+            post = Post.query.get(post_id)
+            post.body = 'edited'
+            db.session.commit()
+            response = self.client.get(url_for('main.index'))
+            self.assertTrue(response.headers['X-Page-Cache'] == 'miss')
+            self.assertTrue('edited' in response.get_data(as_text=True))
+
+            # while a page is regenerated the stale copy is served
+            post.body = 'edited again'
+            db.session.commit()
+            key = ('main.index', (), 1, False)
+            self.assertTrue(page_cache.begin(key) is not None)
+            try:
+                response = self.client.get(url_for('main.index'))
+            finally:
+                page_cache.end(key)
+            self.assertTrue(response.headers['X-Page-Cache'] == 'stale')
+            self.assertFalse('edited again' in response.get_data(as_text=True))
+
+            # new comments invalidate the post page
+            response = self.client.get(url_for('main.post', id=post_id))
+            self.assertTrue(response.headers['X-Page-Cache'] == 'miss')
+            response = self.client.get(url_for('main.post', id=post_id))
+            self.assertTrue(response.headers['X-Page-Cache'] == 'hit')
+            self.add_comments(post_id)
+            response = self.client.get(url_for('main.post', id=post_id))
+            self.assertTrue(response.headers['X-Page-Cache'] == 'miss')
+            self.assertTrue('comment' in response.get_data(as_text=True))
+
+            # logged in users are never served from the cache
+            response = self.client.post(url_for('auth.login'), data={
+                'email': 'user0@example.com',
+                'password': 'cat'
+            })
+            response = self.client.get(url_for('main.index'))
+            self.assertFalse('X-Page-Cache' in response.headers)
+        finally:
+            self.app.config['FLASKY_PAGE_CACHE_TTL'] = 0
+            page_cache.init_app(self.app)
+
+    def test_fragment_cache(self):
+        from app.fragments import fragment_cache
+        self.add_posts(0, 2)
+        post = Post.query.filter_by(body='post #0').first()
+        response = self.client.get(url_for('main.index'))
+        self.assertTrue('post #1' in response.get_data(as_text=True))
+        hits = fragment_cache.hits
+        response = self.client.get(url_for('main.index'))
+        self.assertTrue(fragment_cache.hits == hits + 2)
+
+        # the edit button is only added for the author
+        response = self.client.post(url_for('auth.login'), data={
+            'email': 'user0@example.com',
+            'password': 'cat'
+        })
+        response = self.client.get(url_for('main.index'))
+        data = response.get_data(as_text=True)
+        self.assertTrue(fragment_cache.hits == hits + 4)
+        self.assertTrue('href="/edit/%d"' % post.id in data)
+        other = Post.query.filter_by(body='post #1').first()
+        self.assertFalse('href="/edit/%d"' % other.id in data)
+
+        # a new version of the post is rendered again
+        post.body = 'edited'
+        db.session.commit()
+        response = self.client.get(url_for('main.index'))
+        self.assertTrue('edited' in response.get_data(as_text=True))
+        self.assertTrue(fragment_cache.hits == hits + 5)
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from flask import url_for
+from app import create_app, db
+from app.models import User, Role, Post
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.replica_dir = tempfile.mkdtemp()
+        self.replica = os.path.join(self.replica_dir, 'replica.sqlite')
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///' + self.replica}
+        self.app.config['FLASKY_REPLICA_BINDS'] = ['replica']
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.sync_replica()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(self.app, bind='replica').dispose()
+        shutil.rmtree(self.replica_dir)
+        self.app_context.pop()
+
+    def sync_replica(self):
+        """ bring the replica up to date with a copy of the primary """
+        db.session.commit()
+        db.get_engine(self.app, bind='replica').dispose()
+        shutil.copyfile(db.engine.url.database, self.replica)
+
+    def test_read_after_write(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        db.session.add_all([u, Post(body='replicated', author=u)])
+        self.sync_replica()
+        db.session.add(Post(body='not replicated yet', author=u))
+        db.session.commit()
+        db.session.remove()
+
+        # read-only pages come from the replica
+        response = self.client.get(url_for('main.index'))
+        data = response.get_data(as_text=True)
+        self.assertTrue('replicated' in data)
+        self.assertFalse('not replicated yet' in data)
+
+        # after a write the user reads from the primary
+        response = self.client.post(url_for('auth.login'), data={
+            'email': 'john@example.com',
+            'password': 'cat'
+        })
+        self.assertTrue(response.status_code == 302)
+        response = self.client.get(url_for('main.index'))
+        self.assertTrue('not replicated yet' in
+                        response.get_data(as_text=True))
+
+        # until the replicas have caught up
+        with self.client.session_transaction() as session:
+            session['primary_until'] -= \
+                self.app.config['FLASKY_REPLICA_MAX_LAG']
+        response = self.client.get(url_for('main.user', username='john'))
+        self.assertTrue(response.status_code == 200)
+        self.assertFalse('not replicated yet' in
+                         response.get_data(as_text=True))
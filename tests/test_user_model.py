@@ -1,6 +1,7 @@
 import unittest
 from app import create_app, db
-from app.models import User, Role, Permission, AnonymousUser, Follow, Post
+from app.models import User, Role, Permission, AnonymousUser, Follow, Post, \
+    Comment, Timeline
 import time
 from datetime import datetime
 
@@ -225,3 +226,314 @@ class UserModelTestCase(unittest.TestCase):
         token = u.generate_auth_token()
         u2 = User.verify_auth_token(token + '1')
         self.assertTrue(u != u2)
+
+    def test_counters(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertTrue(u1.followers_count == 1)
+        self.assertTrue(u1.followed_count == 1)
+        u1.follow(u2)
+        p = Post(body='post by john', author=u1)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u1.post_count == 1)
+        self.assertTrue(u1.followed_count == 2)
+        self.assertTrue(u2.followers_count == 2)
+        c = Comment(body='comment by susan', author=u2, post=p)
+        db.session.add(c)
+        db.session.commit()
+        self.assertTrue(p.comment_count == 1)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertTrue(u2.followers_count == 1)
+        self.assertTrue(User.check_counters() == [])
+        self.assertTrue(Post.check_counters() == [])
+
+        # simulate drift and repair it
+        User.query.filter_by(id=u1.id).update({'post_count': 5})
+        db.session.commit()
+        drift = User.check_counters(repair=True)
+        self.assertTrue(drift == [(u1.id, 'post_count', 5, 1)])
+        self.assertTrue(User.check_counters() == [])
+
+    def test_timelines(self):
+        john = User(email='john@example.com', password='cat')
+        susan = User(email='susan@example.org', password='dog')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        db.session.add(Post(body='before the follow', author=john))
+        db.session.commit()
+
+        # following backfills, new posts fan out
+        susan.follow(john)
+        db.session.commit()
+        db.session.add(Post(body='after the follow', author=john))
+        db.session.commit()
+        self.assertTrue(Timeline.query.filter_by(user_id=susan.id).count() == 2)
+        posts = susan.followed_posts.all()
+        self.assertTrue([p.body for p in posts] ==
+                        ['after the follow', 'before the follow'])
+
+        # unfollowing trims
+        susan.unfollow(john)
+        db.session.commit()
+        self.assertTrue(susan.followed_posts.count() == 0)
+
+        # authors going over the fan-out limit are pulled at read time
+        self.app.config['FLASKY_TIMELINE_FANOUT_LIMIT'] = 1
+        susan.follow(john)
+        db.session.commit()
+        self.assertTrue(susan.large_followed_count == 1)
+        self.assertTrue(john.large_followed_count == 1)
+        db.session.add(Post(body='large fan-out', author=john))
+        db.session.commit()
+        self.assertTrue(Timeline.query.count() == 0)
+        self.assertTrue(susan.followed_posts.count() == 3)
+        self.assertTrue(User.check_counters() == [])
+
+        # and pushed again, with the posts written in between, once they are
+        # back under it
+        susan.unfollow(john)
+        db.session.commit()
+        self.assertTrue(susan.large_followed_count == 0)
+        self.assertTrue(john.large_followed_count == 0)
+        self.assertTrue(Timeline.query.filter_by(user_id=john.id).count() == 3)
+        self.assertTrue(john.followed_posts.count() == 3)
+        self.assertTrue(User.check_counters() == [])
+
+        # a new limit is applied by a rebuild
+        susan.follow(john)
+        db.session.commit()
+        self.app.config['FLASKY_TIMELINE_FANOUT_LIMIT'] = 5000
+        Timeline.rebuild()
+        self.assertTrue(Timeline.query.filter_by(user_id=susan.id).count() == 3)
+        self.assertTrue(susan.large_followed_count == 0)
+        self.assertTrue(User.check_counters() == [])
+
+    def test_seed(self):
+        from app.seed import seed
+        seed(users=20, posts=50, comments=80, seed=1, output=lambda m: None)
+        self.assertTrue(User.query.count() == 20)
+        self.assertTrue(Post.query.count() == 50)
+        self.assertTrue(Comment.query.count() == 80)
+        self.assertTrue(User.check_counters() == [])
+        self.assertTrue(Post.check_counters() == [])
+        u = User.query.first()
+        self.assertTrue(u.verify_password('password'))
+        self.assertTrue(u.is_following(u))
+        self.assertTrue(u.followed_posts.count() ==
+                        Post.query.join(Follow,
+                                        Follow.followed_id == Post.author_id)
+                        .filter(Follow.follower_id == u.id).count())
+
+    def test_render_cache(self):
+        from app.rendering import render_cache
+        before = render_cache.stats()
+        p1 = Post(body='a *cached* body')
+        p2 = Post(body='a *cached* body')
+        after = render_cache.stats()
+        self.assertTrue(p1.body_html == p2.body_html ==
+                        '<p>a <em>cached</em> body</p>')
+        self.assertTrue(after['hits'] - before['hits'] >= 1)
+        # an unchanged re-save does not render at all
+        p1.body = p1.body
+        self.assertTrue(render_cache.stats()['hits'] == after['hits'])
+        self.assertTrue(render_cache.stats()['misses'] == after['misses'])
+
+    def test_rerender(self):
+        import os
+        import shutil
+        import tempfile
+        from app.rendering import rerender
+        u = User(email='john@example.com', password='cat')
+        db.session.add_all([u] + [Post(body='post *%d*' % i, author=u)
+                                  for i in range(5)])
+        db.session.commit()
+        Post.query.update({'body_html': None})
+        db.session.commit()
+        versions = dict(db.session.query(Post.id, Post.version))
+        directory = tempfile.mkdtemp()
+        checkpoint = os.path.join(directory, 'checkpoint')
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(message):
+            raise Interrupted()
+
+        try:
+            # a run stopped after its first chunk leaves a checkpoint
+            with self.assertRaises(Interrupted):
+                rerender(Post, processes=1, chunk_size=2,
+                         checkpoint=checkpoint, output=interrupt)
+            self.assertTrue(os.path.exists(checkpoint))
+
+            # the next run resumes after it and removes it when done
+            done = rerender(Post, processes=1, chunk_size=2,
+                            checkpoint=checkpoint, output=lambda m: None)
+            self.assertTrue(done == 3)
+            self.assertFalse(os.path.exists(checkpoint))
+        finally:
+            shutil.rmtree(directory)
+
+        # every row was rendered exactly once
+        rows = db.session.query(Post.id, Post.version, Post.body_html).all()
+        self.assertTrue(len(rows) == 5)
+        for id, version, body_html in rows:
+            self.assertTrue(version == versions[id] + 1)
+            self.assertTrue('<em>' in body_html)
+
+    def test_render_sweep(self):
+        from app.rendering import render_queue
+        u = User(email='john@example.com', password='cat')
+        db.session.add_all([u, Post(body='a *lost* render', author=u)])
+        db.session.commit()
+        # as if the process rendering it had exited
+        Post.query.update({'body_html': None})
+        db.session.commit()
+        self.assertTrue(render_queue.sweep(older_than=60) == 0)
+        self.assertTrue(render_queue.sweep() == 1)
+        render_queue.join()
+        self.assertTrue(db.session.query(Post.body_html).scalar() ==
+                        '<p>a <em>lost</em> render</p>')
+
+    def test_role_cache(self):
+        from app.models import role_cache
+        Role.insert_roles()
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(role_cache.get(u.role_id).name == 'User')
+        self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+
+        # changing a role bumps the cache version
+        version = role_cache.version
+        r = Role.query.filter_by(name='User').first()
+        r.permissions = Permission.FOLLOW
+        db.session.commit()
+        self.assertTrue(role_cache.version > version)
+        self.assertFalse(u.can(Permission.WRITE_ARTICLES))
+        self.assertTrue(u.can(Permission.FOLLOW))
+
+    def test_identity_cache(self):
+        from app.models import load_user, identity_cache
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        id = u.id
+        db.session.remove()
+
+        # the first load caches a snapshot, the next ones merge it
+        u = load_user(str(id))
+        self.assertTrue(u.email == 'john@example.com')
+        db.session.remove()
+        hits = identity_cache.hits
+        u = load_user(str(id))
+        self.assertTrue(identity_cache.hits == hits + 1)
+        self.assertTrue(u.post_count == 0)
+
+        # last_seen updates keep the snapshot, profile changes drop it
+        u.ping()
+        db.session.commit()
+        self.assertTrue(identity_cache.get(id) is not None)
+        u.email = 'susan@example.com'
+        db.session.commit()
+        self.assertTrue(identity_cache.get(id) is None)
+        db.session.remove()
+        self.assertTrue(load_user(str(id)).email == 'susan@example.com')
+
+    def test_last_seen_batching(self):
+        from app.last_seen import last_seen_buffer
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.com', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        before = u1.last_seen
+        version = u1.version
+        time.sleep(0.01)
+
+        # pings are coalesced and do not dirty the session
+        u1.ping()
+        u1.ping()
+        u2.ping()
+        self.assertFalse(db.session.dirty)
+        self.assertTrue(len(last_seen_buffer.pending) == 2)
+        when = u1.last_seen
+        self.assertTrue(when > before)
+
+        # a flush writes them with one batched update
+        self.assertTrue(last_seen_buffer.flush() == 2)
+        self.assertTrue(u1 in db.session)
+        self.assertTrue(db.session.query(User.last_seen).filter_by(
+            id=u1.id).scalar() == when)
+        self.assertTrue(db.session.query(User.version).filter_by(
+            id=u1.id).scalar() == version + 1)
+        self.assertTrue(last_seen_buffer.flush() == 0)
+
+    def test_follow_index(self):
+        from app.follow_index import follow_index
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(follow_index.is_following(u1.id, u2.id))
+        self.assertFalse(follow_index.is_mutual(u1.id, u2.id))
+        self.assertTrue(follow_index.followers_count(u2.id) == 2)
+        self.assertTrue(follow_index.followed_count(u1.id) == 2)
+
+        # the index follows the Follow events and matches a rebuild
+        u2.follow(u1)
+        db.session.commit()
+        self.assertTrue(follow_index.is_mutual(u1.id, u2.id))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u2))
+        state = follow_index.state
+        follow_index.rebuild()
+        self.assertTrue(dict(state[1]) == dict(follow_index.state[1]))
+        self.assertTrue(dict(state[2]) == dict(follow_index.state[2]))
+
+        # a follow only shows in the index once it is committed
+        u1.follow(u2)
+        db.session.flush()
+        self.assertFalse(u1.is_following(u2))
+        db.session.rollback()
+        self.assertFalse(u1.is_following(u2))
+        self.assertTrue(follow_index.state is not None)
+
+        # following asks the database, which can be ahead of the index when
+        # another process wrote the follow
+        db.engine.execute(Follow.__table__.insert().values(
+            follower_id=u1.id, followed_id=u2.id,
+            timestamp=datetime.utcnow()))
+        self.assertFalse(u1.is_following(u2))
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u1.followed.filter_by(followed_id=u2.id).count() == 1)
+
+    def test_add_self_follows(self):
+        Role.insert_roles()
+        Role.insert_roles()
+        self.assertTrue(Role.query.count() == 3)
+        for i in range(5):
+            db.session.add(User(email='user%d@example.com' % i,
+                                password='cat'))
+        db.session.commit()
+        p = Post(body='post', author=User.query.first())
+        db.session.add(p)
+        db.session.commit()
+        db.session.execute(Follow.__table__.delete())
+        db.session.execute(Timeline.__table__.delete())
+        db.session.commit()
+        self.assertTrue(User.add_self_follows(chunk_size=2) == 5)
+        self.assertTrue(User.add_self_follows(chunk_size=2) == 0)
+        self.assertTrue(Follow.query.count() == 5)
+        self.assertTrue(User.check_counters() == [])
+        u = User.query.first()
+        self.assertTrue(u.is_following(u))
+        self.assertTrue(u.followed_posts.count() == 1)